@@ -0,0 +1,24 @@
+import os
+import json
+import subprocess
+
+def get_revision():
+    """
+    Returns:
+        str: git revision of the benchmarked code or None if it's unknown.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_report(report_path, report):
+    """ Method stores a benchmark report, tagged with the git revision, as a JSON file """
+    report = dict(report, revision=get_revision())
+
+    report_dir = os.path.dirname(os.path.abspath(report_path))
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with open(report_path, 'w') as outfile:
+        json.dump(report, outfile, indent=4, separators=(',', ':'), sort_keys=True)
+    print('Report stored in %s' % (report_path))
@@ -1,10 +1,15 @@
 import glob
-import json
 import os
 import cv2
 import sys
-import random
+import time
+import Queue
 import shutil
+import hashlib
+import argparse
+import threading
+import multiprocessing
+import numpy as np
 import builder_blueprint 
 
 import feature
@@ -12,38 +17,90 @@ import tensorflow as tf
 import tensorflow.train as tft
 
 from editor import CropArea, TrainingImagePreview
+from manifest import DirectoryManifest, file_checksum
+from cropcache import CropCache
+from featureindex import open_feature_index
 from types import IntType, StringType, FloatType
 # from PIL import Image
 
-class CroppedImage(object):
-    def __init__(self, img_path, crop):
+""" Scale of training examples relative to the cropped area of a meteorogram """
+resize_factor = 0.5
+
+class MeteorogramImage(object):
+    """
+    Class which represents a decoded meteorogram.
+    The image is decoded once and every crop area is processed at most once, no matter how many blueprint items use it.
+    """
+
+    def __init__(self, img_path):
         """
         Args:
             img_path (str): full path to the full meteorogram image.
+        """
+
+        assert type(img_path) is StringType, 'img_path: passed object of incorrect type'
+
+        self._image = cv2.imread(img_path)
+        if self._image is None:
+            raise ValueError('Unable to decode image %s' % (img_path))
+        self._crops = {}
+
+    def crop(self, crop):
+        """
+        Returns:
+            CroppedImage: training example cut out of the meteorogram.
+        """
+        assert type(crop) is CropArea, 'crop: passed object of incorrect type'
+
+        if not crop.geometry in self._crops:
+            self._crops[crop.geometry] = CroppedImage(self._image, crop)
+        return self._crops[crop.geometry]
+
+class CroppedImage(object):
+    def __init__(self, image, crop):
+        """
+        Args:
+            image (ndarray): decoded full meteorogram image.
             crop (CropArea): area which should be cropped out of the meteorogram in order to prepare a training example.
         """
         
-        assert type(img_path) is StringType, 'img_path: passed object of incorrect type'
+        assert type(image) is np.ndarray, 'image: passed object of incorrect type'
         assert type(crop) is CropArea, 'crop: passed object of incorrect type'
         
-        self._image = cv2.imread(img_path)        
-        self._image = self._image[crop.y_slice, crop.x_slice]
+        self._image = image[crop.y_slice, crop.x_slice]
         self._image = cv2.cvtColor(self._image, cv2.COLOR_RGB2GRAY)
-        self._image = cv2.resize(self._image, (0,0), fx=0.5, fy=0.5)
+        self._image = cv2.resize(self._image, (0,0), fx=resize_factor, fy=resize_factor)
+
+    @property
+    def pixels(self):
+        """
+        Returns:
+            ndarray: uint8 grayscale pixels of the training example.
+        """
+        return self._image
+
+    def encode(self, record_format='jpeg'):
+        """
+        Returns:
+            str: image encoded as JPEG (the same bytes save() writes to a file) or raw uint8 pixels.
+        """
+        if record_format == 'raw':
+            return self._image.tostring()
+        return cv2.imencode('.jpeg', self._image)[1].tostring()
 
     def save(self, destination_path):
         assert type(destination_path) is StringType, 'destination_path: passed object of incorrect type'
         cv2.imwrite(destination_path, self._image)
 
 class MeteoRecordWriter(object):
-    def __init__(self, destination_path):
+    def __init__(self, destination_path, compression=None):
         assert type(destination_path) is StringType, 'destination_path: passed object of incorrect type'
-        self._writer = tf.python_io.TFRecordWriter(destination_path)
+        self._writer = tf.python_io.TFRecordWriter(destination_path, get_record_options(compression))
         self._write_count = 0
 
-    def write(self, example):
+    def write(self, example, key=None):
         assert type(example) is tft.Example, 'example: passed object of incorrect type'                        
-        self._writer.write(example.SerializeToString())
+        self._writer.write(example.SerializeToString(deterministic=True))
         self._write_count += 1
 
         if not self._write_count % 1000:
@@ -54,76 +111,435 @@ class MeteoRecordWriter(object):
         self._write_count = 0
         sys.stdout.flush()
 
+""" Parts of a meteorogram key (YYYYMMDDHH-row-col) which decide the training/validation split """
+split_groups = {
+    'key': lambda key: key,
+    'date': lambda key: key.split('-')[0][:8],
+    'location': lambda key: '-'.join(key.split('-')[1:]),
+}
+
+class MeteoShardedRecordWriter(object):
+    """
+    Class which writes examples into a set of TFRecord shards named <name>-00000-of-000NN.tfrecord.
+    Examples are dealt round-robin to parallel writer threads, each of them starts a new shard
+    when the current one reaches the target size. Shards are numbered when the writer is closed.
+    """
+
+    def __init__(self, destination_dir, name, shard_size, writers=1, compression=None):
+        """
+        Args:
+            destination_dir (str): directory where the shards will be stored.
+            name (str): prefix of the shard names.
+            shard_size (int): target size of a single shard (in bytes, before compression).
+            writers (int): number of parallel writer threads.
+            compression (str): GZIP, ZLIB or None.
+        """
+        assert type(destination_dir) is StringType, 'destination_dir: passed object of incorrect type'
+        assert type(name) is StringType, 'name: passed object of incorrect type'
+        assert type(shard_size) is IntType and shard_size > 0, 'shard_size: passed object of incorrect type'
+        assert type(writers) is IntType and writers > 0, 'writers: passed object of incorrect type'
+
+        self._destination_dir = destination_dir
+        self._name = name
+        self._shard_size = shard_size
+        self._options = get_record_options(compression)
+        self._next_writer = 0
+        self._errors = []
+        self._shards = [[] for _ in range(writers)]
+        self._queues = [Queue.Queue(maxsize=256) for _ in range(writers)]
+        self._threads = [threading.Thread(target=self._run_writer, args=(index,)) for index in range(writers)]
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def write(self, example):
+        assert type(example) is tft.Example, 'example: passed object of incorrect type'
+        self._queues[self._next_writer].put(example.SerializeToString(deterministic=True))
+        self._next_writer = (self._next_writer + 1) % len(self._queues)
+
+    def close(self):
+        """
+        Returns:
+            list: names of the written shards.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+        # Shards are ordered by the position in their writer's sequence, so the numbering is deterministic
+        temp_paths = []
+        for position in range(max(len(shards) for shards in self._shards)):
+            temp_paths += [shards[position] for shards in self._shards if position < len(shards)]
+
+        filenames = []
+        for index, temp_path in enumerate(temp_paths):
+            filename = '%s-%05d-of-%05d.tfrecord' % (self._name, index, len(temp_paths))
+            os.rename(temp_path, os.path.join(self._destination_dir, filename))
+            filenames.append(filename)
+
+        sys.stdout.flush()
+        return filenames
+
+    def _run_writer(self, writer_index):
+        """ Body of a writer thread, writes serialized examples from its queue into consecutive shards """
+        queue = self._queues[writer_index]
+        writer = None
+        written_size = 0
+
+        try:
+            while True:
+                record = queue.get()
+                if record is None:
+                    break
+                if writer is None or written_size >= self._shard_size:
+                    if writer is not None:
+                        writer.close()
+                    temp_path = os.path.join(self._destination_dir, '.%s-%d-%d.part' % (
+                        self._name, writer_index, len(self._shards[writer_index])
+                    ))
+                    self._shards[writer_index].append(temp_path)
+                    writer = tf.python_io.TFRecordWriter(temp_path, self._options)
+                    written_size = 0
+
+                writer.write(record)
+                written_size += len(record)
+        except Exception as error:
+            self._errors.append(error)
+            # Keep draining the queue, so the producer is never blocked
+            while queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.close()
+
 class MeteoTrainingRecordWriter(object):
-    def __init__(self, destination_dir, ratio):
+    """
+    Class which splits examples into the training and the validation set.
+    The split is decided by a stable hash of the example's meteorogram key (or its date or location, if examples
+    are grouped), so a meteorogram stays in the same set across builds and all the examples built from it land
+    in the same set. Every class is split with the same ratio and the resulting split is reported on close.
+    """
+
+    def __init__(self, destination_dir, ratio, shard_size=64 * 1024 * 1024, writers=1, compression=None, record_format='jpeg', split_by='key'):
+        """
+        Args:
+            destination_dir (str): directory where the training and validation shards will be stored.
+            ratio (float): fraction of examples which are used for training.
+            shard_size (int): target size of a single shard (in bytes, before compression).
+            writers (int): number of parallel writer threads of each set.
+            compression (str): GZIP, ZLIB or None.
+            record_format (str): format of the written examples (jpeg or raw), recorded for the trainer.
+            split_by (str): part of the meteorogram key which decides the split, one of split_groups.
+        """
         assert type(destination_dir) is StringType, 'destination_dir: passed object of incorrect type'
         assert type(ratio) is FloatType, 'ratio: passed object of incorrect type'        
+        assert record_format in feature.record_formats, 'record_format: unsupported format'
+        assert split_by in split_groups, 'split_by: unsupported grouping'
         self._ratio = ratio        
-        self._training_writer = MeteoRecordWriter(os.path.join(destination_dir, 'training.TFRecord'))
-        self._validation_writer = MeteoRecordWriter(os.path.join(destination_dir, 'validation.TFRecord'))        
+        self._split_by = split_by
+        self._split_stats = {}
+        self._destination_dir = destination_dir
+        self._compression = compression
+        self._record_format = record_format
 
-    def write(self, example):
+        # Shards of a previous build would be mixed with the new ones
+        for stale_shard in glob.glob(os.path.join(destination_dir, '*-of-*.tfrecord')):
+            os.remove(stale_shard)
+
+        self._training_writer = MeteoShardedRecordWriter(destination_dir, 'training', shard_size, writers, compression)
+        self._validation_writer = MeteoShardedRecordWriter(destination_dir, 'validation', shard_size, writers, compression)
+
+    def write(self, example, key):
+        """
+        Args:
+            example (Example): training example.
+            key (str): key of the meteorogram the example was built from (YYYYMMDDHH-row-col).
+        """
         assert type(example) is tft.Example, 'example: passed object of incorrect type'
-        writer = self._training_writer if random.random() <= self._ratio else self._validation_writer
+        assert type(key) is StringType, 'key: passed object of incorrect type'
+
+        is_training = self._is_training(key)
+        class_label = example.features.feature['image/label'].int64_list.value[0]
+        self._split_stats.setdefault(class_label, [0, 0])[0 if is_training else 1] += 1
+
+        writer = self._training_writer if is_training else self._validation_writer
         writer.write(example)
 
     def close(self):
-        self._training_writer.close()
-        self._validation_writer.close()
+        split = dict(
+            (str(class_label), { 'training': counts[0], 'validation': counts[1] })
+            for class_label, counts in self._split_stats.items()
+        )
+        feature.save_record_set(self._destination_dir, {
+            'compression': self._compression or '',
+            'format': self._record_format,
+            'split': { 'ratio': self._ratio, 'split_by': self._split_by, 'classes': split },
+            'training': self._training_writer.close(),
+            'validation': self._validation_writer.close(),
+        })
+        self._print_split_summary()
+        sys.stdout.flush()
+
+    def _is_training(self, key):
+        group = split_groups[self._split_by](key)
+        bucket = int(hashlib.md5(group).hexdigest()[:8], 16) / float(0x100000000)
+        return bucket < self._ratio
+
+    def _print_split_summary(self):
+        for class_label in sorted(self._split_stats):
+            training, validation = self._split_stats[class_label]
+            print('Class {label}: {training} training, {validation} validation ({ratio:.1%} training)'.format(
+                label=class_label,
+                training=training,
+                validation=validation,
+                ratio=training / float(training + validation),
+            ))
+            if (not training and self._ratio > 0) or (not validation and self._ratio < 1):
+                print('[WARNING] Class {label} is missing in one of the sets'.format(label=class_label))
+
+class BuildProgress(object):
+    """ Class which periodically reports the progress of a build on a single line. """
+
+    def __init__(self, total, interval=1.0):
+        """
+        Args:
+            total (int): number of items to process.
+            interval (float): minimal interval between two reports (in seconds).
+        """
+        assert type(total) is IntType, 'total: passed object of incorrect type'
+
+        self._total = total
+        self._interval = interval
+        self._processed = 0
+        self._started_at = time.time()
+        self._reported_at = 0
+
+    def update(self, count):
+        self._processed += count
+        if time.time() - self._reported_at >= self._interval:
+            self._report()
+
+    def finish(self):
+        self._report()
+        sys.stdout.write('\n')
         sys.stdout.flush()
 
+    def _report(self):
+        self._reported_at = time.time()
+        elapsed = max(self._reported_at - self._started_at, 1e-6)
+        sys.stdout.write('\rProcessed %d/%d items (%.1f items/s)' % (self._processed, self._total, self._processed / elapsed))
+        sys.stdout.flush()
+
+# Task executed by the worker processes of a parallel build.
+# Worker processes are forked, so they inherit it together with the builder and the blueprint it refers to.
+_worker_task = None
+
+def _run_worker_task(chunk):
+    return [_worker_task(*item) for item in chunk]
+
 class MeteoTrainingSetBuilder(object):
-    def __init__(self, images_path, index_path):
+    def __init__(self, images_path, index_path, crop_cache=None):
+        """
+        Args:
+            images_path (str): directory where meteorogram images are stored.
+            index_path (str): path to the feature index file (json or SQLite).
+            crop_cache (CropCache): cache of already built examples, examples are always built if not passed.
+        """
         assert type(images_path) is StringType, 'images_path: passed object of incorrect type'
         assert type(index_path) is StringType, 'index_path: passed object of incorrect type'
+        assert crop_cache is None or type(crop_cache) is CropCache, 'crop_cache: passed object of incorrect type'
 
         self._images_path = images_path
+        self._crop_cache = crop_cache
         self._index_path = index_path
-        self._index = { 'sorted_keys': [], 'values': {} , 'active_index': 0 }
-        self._load_index(index_path)
+        self._index = self._load_index(index_path)
+        self._manifest = DirectoryManifest(images_path)
+
+        # Meteorograms may be put into the directory by other tools than the downloader
+        if self._manifest.exists:
+            changed = self._manifest.sync()
+            # Checksums are keys of the cached examples, so the indexed meteorograms are checked for changes
+            if crop_cache is not None:
+                changed = self._manifest.refresh(training_image + '.png' for training_image, _ in self._get_index_items()) or changed
+            if changed:
+                self._manifest.save()
+
+    def build_intermediate_set(self, blueprint, workers=1, chunk_size=64):
+        """
+        Method builds training examples of all the categorized meteorograms.
+        The result does not depend on the number of workers, every example is stored under its meteorogram's name.
 
-    def build_intermediate_set(self, blueprint):
-        index = 1
+        Args:
+            blueprint (list): blueprint items defining the examples.
+            workers (int): number of processes building the examples.
+            chunk_size (int): number of meteorograms sent to a worker process at once.
+        """
         self._compile_blueprint(blueprint)
 
-        for image_key in self._index['sorted_keys']:
-            if image_key in self._index['values']:
-                features = self._index['values'][image_key].encode('ascii','ignore')
-                training_image = image_key.encode('ascii','ignore')
+        for training_image, item, encoded_image in self.iter_examples(blueprint, workers, chunk_size):
+            self._save_example(training_image, item, encoded_image)
 
-                print('%d Processing item %s -> %s' % (index, training_image, features))
-                self._build_item(training_image, features, blueprint)                
-                index += 1
+    def iter_examples(self, blueprint, workers=1, chunk_size=64, record_format='jpeg'):
+        """
+        Generator of training examples of all the categorized meteorograms, in the index order.
+
+        Yields:
+            tuple: (training_image, blueprint item, example encoded in the record_format)
+        """
+        build_item = lambda training_image, features: self._build_item(training_image, features, blueprint, record_format)
+
+        for examples in self._map_index_items(build_item, workers, chunk_size):
+            for training_image, item_index, encoded_image in examples:
+                yield training_image, blueprint[item_index], encoded_image
+
+    def build_streaming_tfrecord(self, blueprint, record_writer, workers=1, chunk_size=64, keep_intermediate=False, record_format='jpeg'):
+        """
+        Method writes training examples straight into TFRecord files, without the intermediate set.
+
+        Args:
+            blueprint (list): blueprint items defining the examples.
+            record_writer (MeteoTrainingRecordWriter): writer of the TFRecord files.
+            workers (int): number of processes building the examples.
+            chunk_size (int): number of meteorograms sent to a worker process at once.
+            keep_intermediate (bool): additionally save examples in the blueprint's directories (for debugging).
+            record_format (str): jpeg to store JPEG encoded examples, raw to store uint8 pixel buffers.
+        """
+        if keep_intermediate:
+            self._compile_blueprint(blueprint)
+
+        for training_image, item, encoded_image in self.iter_examples(blueprint, workers, chunk_size, record_format):
+            if record_format == 'raw':
+                pixels = decode_raw_example(encoded_image)
+                record_writer.write(feature.create_raw_example(pixels, get_item_label(item)), training_image)
+                if keep_intermediate:
+                    self._save_example(training_image, item, cv2.imencode('.jpeg', pixels)[1].tostring())
+            else:
+                record_writer.write(feature.create_encoded_example(encoded_image, get_item_label(item)), training_image)
+                if keep_intermediate:
+                    self._save_example(training_image, item, encoded_image)
+
+        record_writer.close()
 
     def build_tfrecord(self, training_dir, record_writer):        
         for class_dir in glob.glob(os.path.join(training_dir, "*")):
             for example_file in glob.glob(os.path.join(class_dir, "*")):                    
                 example = feature.create_example(example_file)
-                record_writer.write(example)
+                record_writer.write(example, os.path.splitext(os.path.basename(example_file))[0])
 
         record_writer.close()
 
+    def _get_index_items(self):
+        """ Method returns (training_image, features) pairs of all the categorized meteorograms """
+        return [
+            (image_key.encode('ascii','ignore'), features.encode('ascii','ignore'))
+            for image_key, features in self._index.labeled_items()
+        ]
+
+    def _map_index_items(self, fn, workers, chunk_size):
+        """
+        Generator of fn(training_image, features) results for all the categorized meteorograms, in the index order.
+        With more than one worker the items are processed in chunks by a pool of forked processes.
+        """
+        global _worker_task
+
+        assert type(workers) is IntType and workers > 0, 'workers: passed object of incorrect type'
+        assert type(chunk_size) is IntType and chunk_size > 0, 'chunk_size: passed object of incorrect type'
+
+        items = self._get_index_items()
+        progress = BuildProgress(len(items))
+
+        if workers == 1:
+            for item in items:
+                yield fn(*item)
+                progress.update(1)
+        else:
+            _worker_task = fn
+            pool = multiprocessing.Pool(workers)
+            try:
+                chunks = [items[start:start+chunk_size] for start in range(0, len(items), chunk_size)]
+                for results in pool.imap(_run_worker_task, chunks):
+                    for result in results:
+                        yield result
+                    progress.update(len(results))
+            finally:
+                pool.close()
+                pool.join()
+                _worker_task = None
+
+        progress.finish()
+
     def _load_index(self, index_path):
         """ Method loads features index from a file  """
 
         if not os.path.exists(index_path):
             raise ValueError('File or directory %s does not exists' % (index_path))
 
-        with open(index_path) as infile:
-            self._index = json.load(infile)
+        return open_feature_index(index_path)
+
+    def _build_item(self, training_image, features, blueprint, record_format='jpeg'):
+        """
+        Method builds training examples based on meteorogram and blueprint
 
-    def _build_item(self, training_image, features, blueprint):
-        """ Method builds training examples based on meteorogram and blueprint """
+        Returns:
+            list: (training_image, index of the blueprint item, example encoded in the record_format) tuples.
+        """
         source_path = os.path.join(self._images_path, training_image + '.png')
-        
-        for item in blueprint:            
-            if item['accept_fn'](features):
-                output_filename = training_image + '.jpeg'
-                if not os.path.exists(source_path):
-                    print('[ERROR] Path not exists:' + source_path)
-                    return
-                image = CroppedImage(source_path, item['crop_area'])                
-                image.save(os.path.join(item['destination_dir'], output_filename))                    
+        accepted_items = [index for index, item in enumerate(blueprint) if item['accept_fn'](features)]
+
+        if not accepted_items:
+            return []
+        if not self._source_exists(training_image + '.png', source_path):
+            print('[ERROR] Path not exists:' + source_path)
+            return []
+
+        if self._crop_cache is not None:
+            source_checksum = self._source_checksum(training_image + '.png', source_path)
+
+        meteorogram = None
+        examples = []
+        for index in accepted_items:
+            crop_area = blueprint[index]['crop_area']
+            encoded_image = None
+
+            if self._crop_cache is not None:
+                cache_key = CropCache.key(source_checksum, crop_area.geometry, resize_factor, record_format)
+                encoded_image = self._crop_cache.get(cache_key)
+
+            if encoded_image is None:
+                try:
+                    meteorogram = meteorogram or MeteorogramImage(source_path)
+                except ValueError as error:
+                    print('[ERROR] ' + str(error))
+                    return []
+                encoded_image = meteorogram.crop(crop_area).encode(record_format)
+
+                if self._crop_cache is not None:
+                    self._crop_cache.put(cache_key, encoded_image)
+
+            examples.append((training_image, index, encoded_image))
+        return examples
+
+    def _save_example(self, training_image, item, encoded_image):
+        """ Method stores an encoded example in the blueprint item's directory """
+        with open(os.path.join(item['destination_dir'], training_image + '.jpeg'), 'wb') as outfile:
+            outfile.write(encoded_image)
+
+    def _source_exists(self, filename, source_path):
+        """ Method checks the presence of a meteorogram in the manifest, or on disk if there is no manifest """
+        if self._manifest.exists:
+            return filename in self._manifest
+        return os.path.exists(source_path)
+
+    def _source_checksum(self, filename, source_path):
+        """ Method returns the checksum of a meteorogram, taken from the manifest if available """
+        entry = self._manifest.get(filename) if self._manifest.exists else None
+        if entry is not None:
+            return entry['checksum']
+        return file_checksum(source_path)
 
     def _compile_blueprint(self, blueprint):
         """ Method creates directories required by blueprint items """
@@ -139,6 +555,30 @@ def get_paths_for(operation):
 
     return intermediate_path, source_images_path, index_path
 
+def get_record_options(compression):
+    """
+    Returns:
+        TFRecordOptions: options of a TFRecordWriter using GZIP, ZLIB or no compression (None).
+    """
+    if not compression:
+        return None
+    return tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+
+def decode_raw_example(encoded_image):
+    """
+    Returns:
+        ndarray: uint8 pixels of an example encoded in the raw format.
+    """
+    return np.frombuffer(encoded_image, dtype=np.uint8).reshape((feature.input_height, feature.input_width))
+
+def get_item_label(item):
+    """
+    Returns:
+        int: class label of the blueprint item, encoded in its destination directory name (e.g. wind-none_1).
+    """
+    class_label, _ = feature._get_tf_class(os.path.normpath(item['destination_dir']))
+    return class_label
+
 def rmifexists(path):
     if os.path.exists(path):
         shutil.rmtree(path)    
@@ -147,26 +587,66 @@ def rmifexists(path):
 if __name__ == "__main__":
     
     # HELP
-    # python2.7 builder blueprint input_path index_path output_path intermediate_path
-    # python2.7 builder.py wind ../data/training-images ../data/training-set-index.json ../data/wind-model/records/ ../data/tmp/intermediate-set
+    # python2.7 builder blueprint input_path index_path output_path [--intermediate-path PATH] [--workers N] [--chunk-size N]
+    # python2.7 builder.py wind ../data/training-images ../data/training-set-index.json ../data/wind-model/records/
+    # python2.7 builder.py wind ../data/training-images ../data/training-set-index.json ../data/wind-model/records/ --cache-dir ../data/tmp/crop-cache
+    # python2.7 builder.py wind ../data/training-images ../data/training-set-index.json ../data/wind-model/records/ --intermediate-path ../data/tmp/intermediate-set
+    # python2.7 builder.py wind ../data/training-images ../data/training-set-index.json ../data/wind-model/records/ --intermediate-path ../data/tmp/intermediate-set --workers 32
+
+    parser = argparse.ArgumentParser(description='Builds TFRecord files from categorized meteorograms')
+    parser.add_argument('blueprint_name', choices=sorted(builder_blueprint.index.keys()))
+    parser.add_argument('input_path', help='directory where meteorogram images are stored')
+    parser.add_argument('index_path', help='path to the feature index file')
+    parser.add_argument('output_path', help='directory where the TFRecord files will be stored')
+    parser.add_argument('--intermediate-path', help='directory where training examples are additionally stored as JPEG files (for debugging)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes building the training examples')
+    parser.add_argument('--chunk-size', type=int, default=64, help='number of meteorograms sent to a worker process at once')
+    parser.add_argument('--shard-size', type=int, default=64, help='target size of a single TFRecord shard (in MB)')
+    parser.add_argument('--record-writers', type=int, default=1, help='number of parallel writers of each set of shards')
+    parser.add_argument('--compression', choices=['GZIP', 'ZLIB'], help='compression of the TFRecord shards')
+    parser.add_argument('--format', choices=feature.record_formats, default='jpeg', help='stored examples, JPEG encoded images or raw uint8 pixels')
+    parser.add_argument('--split-by', choices=sorted(split_groups.keys()), default='key', help='keep meteorograms of the same date or location in the same set')
+    parser.add_argument('--cache-dir', help='directory of the cache of already built training examples')
+    parser.add_argument('--cache-size', type=int, default=1024, help='maximum size of the cache (in MB)')
+    args = parser.parse_args()
 
     # Preparing the training set
-    blueprint_name = sys.argv[1]
-    input_path = sys.argv[2]
-    index_path = sys.argv[3]
-    output_path = sys.argv[4] # '../data/wind-model/records/' # INPUT PARAMETER
-    intermediate_path = sys.argv[5]
+    blueprint_name = args.blueprint_name
+    input_path = args.input_path
+    index_path = args.index_path
+    output_path = args.output_path # '../data/wind-model/records/' # INPUT PARAMETER
+    intermediate_path = args.intermediate_path
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
     # intermediate_path, source_images_path, index_path = get_paths_for('training')
-    blueprint = builder_blueprint.index[blueprint_name](intermediate_path)
-    rmifexists(intermediate_path)
-
-    builder = MeteoTrainingSetBuilder(input_path, index_path)    
-    builder.build_intermediate_set(blueprint)
-    builder.build_tfrecord(intermediate_path, MeteoTrainingRecordWriter(output_path, 0.8))    
+    blueprint = builder_blueprint.index[blueprint_name](intermediate_path or '')
+    if intermediate_path:
+        rmifexists(intermediate_path)
+
+    crop_cache = CropCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+
+    builder = MeteoTrainingSetBuilder(input_path, index_path, crop_cache)    
+    builder.build_streaming_tfrecord(
+        blueprint,
+        MeteoTrainingRecordWriter(
+            output_path,
+            0.8,
+            shard_size=args.shard_size * 1024 * 1024,
+            writers=args.record_writers,
+            compression=args.compression,
+            record_format=args.format,
+            split_by=args.split_by
+        ),
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        keep_intermediate=bool(intermediate_path),
+        record_format=args.format
+    )
+
+    if crop_cache is not None:
+        print('Evicted %d cached examples' % (crop_cache.evict()))
 
     # Preparing the prediction sets
     # intermediate_path, source_images_path, index_path = get_paths_for('prediction')
@@ -0,0 +1,202 @@
+import os
+import cv2
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+import builder_blueprint
+
+from builder import MeteoTrainingSetBuilder, MeteoTrainingRecordWriter, rmifexists
+from benchmark import save_report
+
+""" Size of a meteorogram published by meteo.pl (in pixels) """
+canvas_width = 540
+canvas_height = 660
+
+""" Vertical offsets of the precipitation, wind and clouds panels, matching crop areas of the blueprints """
+panel_offsets = [140, 314, 522]
+
+""" Labels assigned to synthetic meteorograms, every blueprint class is represented """
+synthetic_labels = ['U', 'R', 'S', 'RS', 'W', 'C', 'RC', 'SC', 'RWC', 'SW', 'WC', 'RSWC']
+
+def synthetic_meteorogram(random_state):
+    """
+    Returns:
+        ndarray: BGR image resembling a meteorogram, a grid and a random plot in every panel.
+    """
+    image = np.full((canvas_height, canvas_width, 3), 255, dtype=np.uint8)
+    for panel_y in panel_offsets:
+        for x in range(65, canvas_width, 30):
+            cv2.line(image, (x, panel_y), (x, panel_y + 85), (200, 200, 200), 1)
+        for y in range(panel_y, panel_y + 86, 17):
+            cv2.line(image, (65, y), (canvas_width - 20, y), (200, 200, 200), 1)
+
+        values = np.cumsum(random_state.randint(-4, 5, 60)) + random_state.randint(20, 65)
+        points = np.array([
+            [65 + x * 7, panel_y + int(np.clip(value, 0, 85))] for x, value in enumerate(values)
+        ], dtype=np.int32)
+        color = tuple(int(channel) for channel in random_state.randint(0, 200, 3))
+        cv2.polylines(image, [points], False, color, 2)
+    return image
+
+def generate_data_set(images_dir, index_path, count, seed=0):
+    """
+    Method generates count synthetic meteorograms and a feature index in the training-set-index.json schema.
+    An already generated data set of the same size is reused.
+    """
+    if os.path.exists(index_path):
+        with open(index_path) as infile:
+            if len(json.load(infile)['sorted_keys']) == count:
+                return
+
+    rmifexists(images_dir)
+    os.makedirs(images_dir)
+
+    random_state = np.random.RandomState(seed)
+    label_random = random.Random(seed)
+    first_date = datetime.date(2018, 1, 1)
+    index = { 'sorted_keys': [], 'values': {}, 'active_index': 0 }
+
+    for item in range(count):
+        date = first_date + datetime.timedelta(days=item // 72)
+        key = '{date!s}{time:02d}-{row!s}-{col!s}'.format(
+            date=date.strftime("%Y%m%d"),
+            time=(item % 4) * 6,
+            row=300 + (item // 4) % 18,
+            col=200,
+        )
+        cv2.imwrite(os.path.join(images_dir, key + '.png'), synthetic_meteorogram(random_state))
+        index['sorted_keys'].append(key)
+        index['values'][key] = label_random.choice(synthetic_labels)
+
+    with open(index_path, 'w') as outfile:
+        json.dump(index, outfile, indent=4, separators=(',', ':'))
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+def peak_rss_mb():
+    """
+    Returns:
+        float: peak resident set size of the process and its finished children (in MB).
+    """
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / scale
+
+def measure_build(images_dir, index_path, blueprint_name, work_dir, workers):
+    """
+    Method builds TFRecords of a single blueprint through the intermediate set and through streaming.
+
+    Returns:
+        dict: wall time, images per second and touched files of every build stage.
+    """
+    intermediate_dir = os.path.join(work_dir, 'intermediate')
+    records_dir = os.path.join(work_dir, 'records')
+    rmifexists(intermediate_dir)
+    rmifexists(records_dir)
+    os.makedirs(records_dir)
+
+    blueprint = builder_blueprint.index[blueprint_name](intermediate_dir)
+    builder = MeteoTrainingSetBuilder(images_dir, index_path)
+    images_count = len([
+        item for item in builder._get_index_items() if any(entry['accept_fn'](item[1]) for entry in blueprint)
+    ])
+    stages = {}
+
+    started_at = time.time()
+    builder.build_intermediate_set(blueprint, workers=workers)
+    elapsed = time.time() - started_at
+    stages['build_intermediate_set'] = {
+        'seconds': elapsed,
+        'images_per_second': images_count / max(elapsed, 1e-6),
+        'files_read': images_count,
+        'files_written': count_files(intermediate_dir),
+    }
+
+    started_at = time.time()
+    builder.build_tfrecord(intermediate_dir, MeteoTrainingRecordWriter(records_dir, 0.8))
+    elapsed = time.time() - started_at
+    stages['build_tfrecord'] = {
+        'seconds': elapsed,
+        'images_per_second': images_count / max(elapsed, 1e-6),
+        'files_read': count_files(intermediate_dir),
+        'files_written': count_files(records_dir),
+    }
+
+    rmifexists(records_dir)
+    os.makedirs(records_dir)
+    started_at = time.time()
+    builder.build_streaming_tfrecord(blueprint, MeteoTrainingRecordWriter(records_dir, 0.8), workers=workers)
+    elapsed = time.time() - started_at
+    stages['build_streaming_tfrecord'] = {
+        'seconds': elapsed,
+        'images_per_second': images_count / max(elapsed, 1e-6),
+        'files_read': images_count,
+        'files_written': count_files(records_dir),
+    }
+
+    return { 'images': images_count, 'stages': stages }
+
+def _run_measurement(result_queue, *args):
+    result = measure_build(*args)
+    result['peak_rss_mb'] = peak_rss_mb()
+    result_queue.put(result)
+
+def measure_build_in_process(*args):
+    """ Method runs measure_build in a separate process, so peak memory usage of every build is reported separately """
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_measurement, args=(result_queue,) + args)
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+# Execution section
+if __name__ == "__main__":
+
+    # HELP
+    # python2.7 builder_benchmark.py report_path [--scales N [N ...]] [--blueprints NAME [NAME ...]] [--workers N] [--work-dir PATH]
+    # python2.7 builder_benchmark.py ../data/benchmarks/builder.json
+    # python2.7 builder_benchmark.py ../data/benchmarks/builder.json --scales 1000 10000 100000 --workers 8 --work-dir ../data/tmp/builder-benchmark
+
+    parser = argparse.ArgumentParser(description='Measures the builder on synthetic meteorograms')
+    parser.add_argument('report_path', help='path where the JSON report will be stored')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000], help='numbers of synthetic meteorograms')
+    parser.add_argument('--blueprints', nargs='+', choices=sorted(builder_blueprint.index.keys()), default=sorted(builder_blueprint.index.keys()))
+    parser.add_argument('--workers', type=int, default=1, help='number of processes building the training examples')
+    parser.add_argument('--work-dir', help='directory where the synthetic data sets are kept between runs (temporary by default)')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='builder-benchmark-')
+    try:
+        results = []
+        for scale in args.scales:
+            images_dir = os.path.join(work_dir, '%d-images' % (scale))
+            index_path = os.path.join(work_dir, '%d-set-index.json' % (scale))
+            print('Generating %d synthetic meteorograms' % (scale))
+            generate_data_set(images_dir, index_path, scale)
+
+            for blueprint_name in args.blueprints:
+                print('Benchmarking blueprint %s at %d meteorograms' % (blueprint_name, scale))
+                result = measure_build_in_process(images_dir, index_path, blueprint_name, os.path.join(work_dir, 'build'), args.workers)
+                result.update({ 'scale': scale, 'blueprint': blueprint_name })
+                results.append(result)
+
+        save_report(args.report_path, {
+            'workers': args.workers,
+            'canvas': [canvas_width, canvas_height],
+            'results': results,
+        })
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
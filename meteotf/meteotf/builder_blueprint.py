@@ -27,7 +27,8 @@ def precipitation_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label
             ),
-            'accept_fn': accept_fn_index['precipitation-rain']            
+            'accept_fn': accept_fn_index['precipitation-rain'],
+            'features': 'R'
         },
         {
             'class_name': 'precipitation-snow',
@@ -36,7 +37,8 @@ def precipitation_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label + 1
             ),
-            'accept_fn': accept_fn_index['precipitation-snow']
+            'accept_fn': accept_fn_index['precipitation-snow'],
+            'features': 'S'
         },        
         {
             'class_name': 'precipitation-none',
@@ -45,7 +47,8 @@ def precipitation_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label + 2
             ),
-            'accept_fn': accept_fn_index['precipitation-none']
+            'accept_fn': accept_fn_index['precipitation-none'],
+            'features': ''
         }       
     ]
 
@@ -58,7 +61,8 @@ def sleet_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label
             ),
-            'accept_fn': accept_fn_index['precipitation-sleet']
+            'accept_fn': accept_fn_index['precipitation-sleet'],
+            'features': 'RS'
         }, 
     ]
 
@@ -71,7 +75,8 @@ def wind_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label,
             ),
-            'accept_fn': accept_fn_index['wind-strong']
+            'accept_fn': accept_fn_index['wind-strong'],
+            'features': 'W'
         },
         {
             'class_name': 'wind-none',
@@ -80,7 +85,8 @@ def wind_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label+1,
             ),
-            'accept_fn': accept_fn_index['wind-none']
+            'accept_fn': accept_fn_index['wind-none'],
+            'features': ''
         }       
     ]
 
@@ -93,7 +99,8 @@ def clouds_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label,
             ),
-            'accept_fn': accept_fn_index['clouds-present']
+            'accept_fn': accept_fn_index['clouds-present'],
+            'features': 'C'
         },
         {
             'class_name': 'clouds-none',
@@ -102,7 +109,8 @@ def clouds_blueprint(intermediate_path, start_label=0):
                 root=intermediate_path,
                 label=start_label+1,
             ),
-            'accept_fn': accept_fn_index['clouds-none']
+            'accept_fn': accept_fn_index['clouds-none'],
+            'features': ''
         }
     ] 
 
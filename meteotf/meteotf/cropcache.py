@@ -0,0 +1,98 @@
+import os
+import hashlib
+
+from manifest import write_atomically
+from types import StringType, IntType
+
+class CropCache(object):
+    """
+    Class which stores encoded training examples on disk, addressed by the content they were built from.
+    Key of an example consists of the source meteorogram's checksum, the crop geometry, the resize factor
+    and the record format, so an example is rebuilt only if its source image or the way it's cut out changes.
+
+    The cache is size bounded, the least recently used examples are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        """
+        Args:
+            cache_dir (str): Directory where the cached examples are stored.
+            max_size (int): Maximum total size of the cached examples (in bytes).
+        """
+
+        assert type(cache_dir) is StringType, 'cache_dir: passed object of incorrect type'
+        assert type(max_size) is IntType, 'max_size: passed object of incorrect type'
+
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def key(source_checksum, geometry, resize_factor, record_format='jpeg'):
+        """
+        Returns:
+            str: Key of an example cut out of the source image.
+        """
+        return hashlib.sha1(repr((source_checksum, tuple(geometry), resize_factor, record_format))).hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            str: Encoded example or None if it's not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as infile:
+                data = infile.read()
+        except IOError:
+            return None
+
+        # Access time is tracked with mtime, atime is often disabled on the mount
+        os.utime(path, None)
+        return data
+
+    def put(self, key, data):
+        """ Method atomically stores an encoded example, it's safe to call from several processes """
+        path = self._path(key)
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass # created by another process in the meantime
+
+        write_atomically(path, data)
+
+    def evict(self):
+        """
+        Method removes the least recently used examples until the cache fits in max_size.
+
+        Returns:
+            int: Number of removed examples.
+        """
+        entries = []
+        total_size = 0
+        for entry_dir in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, entry_dir)
+            if not os.path.isdir(entry_dir):
+                continue
+            for filename in os.listdir(entry_dir):
+                if filename.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(entry_dir, filename))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(entry_dir, filename)))
+                total_size += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            removed += 1
+        return removed
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, key[:2], key)
@@ -1,14 +1,18 @@
 import cv2
 import glob
+import bisect
 import copy
 import os
-import json
 import re
 import sys
+import threading
 import builder_blueprint
 
-from types import IntType, StringType
-from Tkinter import Button, Label, Checkbutton, Text, StringVar, Tk, S, W, N, E, END, CENTER
+from collections import OrderedDict
+from manifest import DirectoryManifest
+from featureindex import open_feature_index, load_suggestions
+from types import IntType, FloatType, StringType
+from Tkinter import Button, Label, Checkbutton, OptionMenu, Text, StringVar, Tk, S, W, N, E, END, CENTER
 from PIL import Image, ImageTk
 
 class FeatureSet(object):
@@ -77,36 +81,39 @@ class TrainingDataStore(object):
     Class responsible for providing paths for unprocessed meteorograms.
 
     Args:
-        preview_path (str): Full path where the temporary preview image is stored.
         total_files_count (int): Total number of files which need to be processed.
         current_file_index (int): Index of the first unprocessed file.
     """
 
-    _index = { "sorted_keys": [], "values": {} }
-
-    def __init__(self, input_dir, index_path, preview_path):
+    def __init__(self, input_dir, index_path, low_confidence=0.8):
         """
         Args:
             input_dir (str): Path to the directory which contains meteorograms.
-            index_path (int): Path to the json file which stores categories assigned to each input.
-            preview_path (int): Path to a file where a temporary meteorogram preview will be stored.
+            index_path (int): Path to the index file (json or SQLite) which stores categories assigned to each input.
+            low_confidence (float): Labels suggested with a lower confidence are reviewed in the low confidence mode.
         """
 
         assert type(input_dir) is StringType, 'input_dir: passed object of incorrect type'
         assert type(index_path) is StringType, 'index_path: passed object of incorrect type'
-        assert type(preview_path) is StringType, 'preview_path: passed object of incorrect type'
+        assert type(low_confidence) is FloatType, 'low_confidence: passed object of incorrect type'
 
         self._input_dir = input_dir
         self._index_path = index_path
-        self.preview_path = preview_path        
+        self._low_confidence = low_confidence
+
+        # Load index from file, uncategorized meteorograms are pre-filled with labels suggested by prelabel.py
+        self._index = open_feature_index(index_path)
+        self._suggestions = load_suggestions(index_path)
 
-        # Load index from file
-        if os.path.exists(index_path):
-            with open(index_path) as infile:
-                self._index = json.load(infile)
+        # Journaled index is compacted in the background, so saving it doesn't block the UI
+        self._compaction_requested = threading.Event()
+        if self._index.is_journaled:
+            compaction = threading.Thread(target=self._run_compaction)
+            compaction.daemon = True
+            compaction.start()
 
         # Scan input_dir if index is empty 
-        if len(self._index["sorted_keys"]) == 0:
+        if len(self._index) == 0:
             self._scan_input_dir(self._input_dir)
             self.dump_index()
 
@@ -114,13 +121,15 @@ class TrainingDataStore(object):
         self.current_file_index = self._get_first_unprocessed_index()
         assert self.total_files_count > 0, 'Not found any meteorograms to process'
 
+        self._build_posting_lists()
+
     @property
     def total_files_count(self):
         """
         Returns:
             int: total number of meteorogram images in the input_dir.
         """
-        return len(self._index["sorted_keys"])
+        return len(self._index)
 
     def get_training_input(self, index):
         """
@@ -129,12 +138,18 @@ class TrainingDataStore(object):
         """
         assert type(index) is IntType
 
-        self.current_file_index = min(index, len(self._index["sorted_keys"])-1)
-        current_item = self._index["sorted_keys"][self.current_file_index].encode('ascii','ignore')
-        current_item_path = os.path.join(self._input_dir, current_item + ".png")
-        features = '' if not current_item in self._index["values"] else self._index["values"][current_item]
+        self.current_file_index = min(index, len(self._index)-1)
+        current_item = self._index.key_at(self.current_file_index)
+        features = self._index.get_label(current_item) or self._suggestions.get(current_item, {}).get('label', '')
+
+        return TrainingInput(self.image_path(self.current_file_index), features.encode('ascii','ignore'))
 
-        return TrainingInput(current_item_path, features.encode('ascii','ignore'))
+    def image_path(self, index):
+        """
+        Returns:
+            str: Path to the meteorogram image at the specified index.
+        """
+        return os.path.join(self._input_dir, self._index.key_at(index).encode('ascii','ignore') + ".png")
 
     def update_training_input(self, training_input):
         """
@@ -147,28 +162,118 @@ class TrainingDataStore(object):
         assert type(training_input) is TrainingInput, 'training_input: passed object of incorrect type'        
 
         filename = os.path.splitext(os.path.basename(training_input.path))[0]
-        self._index["values"][filename] = training_input.features.label        
+        label = training_input.features.label
+
+        position = self._positions.get(filename)
+        if position is not None:
+            self._move_posting(position, self._index.get_label(filename) or '', label)
+            self._remove_position(self._low_confidence_positions, position)
+        self._index.set_label(filename, label)
+
+    def next_accepted_index(self, index, accept_fn):
+        """
+        Method finds the first meteorogram at or after the index whose label is accepted by accept_fn.
+        Not categorized meteorograms have an empty label.
+
+        Returns:
+            int: Index of the accepted meteorogram.
+
+        Raises:
+            ValueError: If there are no more accepted meteorograms.
+        """
+        candidates = []
+        for label, positions in self._postings.items():
+            if positions and accept_fn(label):
+                offset = bisect.bisect_left(positions, index)
+                if offset < len(positions):
+                    candidates.append(positions[offset])
+
+        if len(candidates) == 0:
+            raise ValueError('No more meteorograms accepted by the filter after %d' % (index))
+        return min(candidates)
+
+    def next_low_confidence_index(self, index):
+        """
+        Method finds the first uncategorized meteorogram at or after the index whose suggested label has a low confidence.
+
+        Returns:
+            int: Index of the meteorogram.
+
+        Raises:
+            ValueError: If there are no more such meteorograms.
+        """
+        offset = bisect.bisect_left(self._low_confidence_positions, index)
+        if offset == len(self._low_confidence_positions):
+            raise ValueError('No more low confidence suggestions after %d' % (index))
+        return self._low_confidence_positions[offset]
 
     def dump_index(self):
-        """ Method which saves the current state of the index to file """
-        with open(self._index_path, 'w') as outfile:
-            json.dump(self._index, outfile, indent=4, separators=(',', ':'))
+        """
+        Method which saves the current state of the index to file.
+        Every label of a journaled index is already persisted, so it's only compacted in the background.
+        """
+        if self._index.is_journaled:
+            self._compaction_requested.set()
+        else:
+            self._index.save()
+            print("Index dumped")
+
+    def close(self):
+        """ Method saves and closes the index, it's called when the editor is closed """
+        self._index.save()
+        self._index.close()
+
+    def _run_compaction(self):
+        while True:
+            self._compaction_requested.wait()
+            self._compaction_requested.clear()
+            self._index.save()
             print("Index dumped")
 
     def _get_first_unprocessed_index(self):
         """ Method returns an index of first unprocessed meteorogram image """
-        index = 0
-        for training_item in self._index["sorted_keys"]:            
-            if not training_item in self._index["values"]: # is already processed?
-                break
-            index += 1
-        return index        
+        return self._index.first_unlabeled_position()
+
+    def _build_posting_lists(self):
+        """
+        Method groups sorted positions of the meteorograms by their labels. There are only a few distinct labels,
+        so positions accepted by any filter are found by a binary search in each of the accepted groups.
+        """
+        self._positions = {}
+        self._postings = {}
+        self._low_confidence_positions = []
+        for position, (key, label) in enumerate(self._index.items()):
+            self._positions[key] = position
+            self._postings.setdefault((label or '').encode('ascii','ignore'), []).append(position)
+
+            if label is None and self._suggestions.get(key, {}).get('confidence', 1.0) < self._low_confidence:
+                self._low_confidence_positions.append(position)
+
+    def _move_posting(self, position, old_label, new_label):
+        """ Method moves the position of a relabeled meteorogram between the groups """
+        self._remove_position(self._postings.get(old_label.encode('ascii','ignore'), []), position)
+        bisect.insort(self._postings.setdefault(new_label, []), position)
+
+    def _remove_position(self, positions, position):
+        offset = bisect.bisect_left(positions, position)
+        if offset < len(positions) and positions[offset] == position:
+            del positions[offset]
 
     def _scan_input_dir(self, input_dir):
-        """ Method scans input_dir and puts names of all meteorogram images to the index """
-        for path in glob.iglob(input_dir+'*.png'):            
-            filename = os.path.splitext(os.path.basename(path))[0]
-            self._index["sorted_keys"].append(filename)
+        """
+        Method scans input_dir and puts names of all meteorogram images to the index.
+        If the downloader left a manifest next to input_dir, names are taken from it instead of walking the directory,
+        the manifest is synced first, so images put into the directory by other tools are found as well.
+        """
+        manifest = DirectoryManifest(input_dir)
+        if manifest.exists:
+            if manifest.sync():
+                manifest.save()
+            paths = sorted(filename for filename in manifest.filenames if filename.endswith('.png'))
+        else:
+            paths = glob.iglob(input_dir+'*.png')
+
+        self._index.append_keys([os.path.splitext(os.path.basename(path))[0] for path in paths])
 
 class CropArea(object): 
     """
@@ -221,6 +326,14 @@ class CropArea(object):
         self.x_slice = slice(self.x-width, self.x+self.width+width)
         self.y_slice = slice(self.y-width,self.y+self.height+width)              
 
+    @property
+    def geometry(self):
+        """
+        Returns:
+            tuple: Boundaries of the area including its outline, equal for areas which crop the same pixels.
+        """
+        return (self.x_slice.start, self.x_slice.stop, self.y_slice.start, self.y_slice.stop)
+
     @property
     def dup(self):
         """ 
@@ -264,6 +377,13 @@ class TrainingImagePreview(object):
         """
         return cv2.copyMakeBorder(focus, outline, outline, outline, outline, cv2.BORDER_CONSTANT, value=[0,0,255])
 
+    def to_image(self):
+        """
+        Returns:
+            Image: Preview as a PIL image which can be displayed without storing it on the disk.
+        """
+        return Image.fromarray(cv2.cvtColor(self.preview, cv2.COLOR_BGR2RGB))
+
     def save(self, destination_path):
         """
         Method saves full preview image into a specified destination file.
@@ -280,6 +400,74 @@ class TrainingImagePreview(object):
         assert type(destination_path) is StringType, 'destination_path: passed object of incorrect type'
         cv2.imwrite(destination_path, self.preview)
 
+class PreviewCache(object):
+    """
+    Class which renders previews of the upcoming meteorograms in a background thread.
+    Rendered previews are kept in a bounded cache, the least recently used ones are dropped first.
+
+    Previews are stored as PIL images, PhotoImage objects have to be created on the Tk thread.
+    """
+
+    def __init__(self, crop, max_size):
+        """
+        Args:
+            crop (CropArea): area highlighted on the previews.
+            max_size (int): maximum number of previews kept in the cache.
+        """
+
+        assert type(crop) is CropArea, 'crop: passed object of incorrect type'
+        assert type(max_size) is IntType, 'max_size: passed object of incorrect type'
+
+        self._crop = crop
+        self._max_size = max_size
+        self._previews = OrderedDict()
+        self._pending = []
+        self._condition = threading.Condition()
+
+        worker = threading.Thread(target=self._run_worker)
+        worker.daemon = True
+        worker.start()
+
+    def get(self, img_path):
+        """
+        Returns:
+            Image: Preview of the meteorogram, it's rendered immediately if it wasn't prefetched.
+        """
+        with self._condition:
+            if img_path in self._previews:
+                preview = self._previews.pop(img_path)
+                self._previews[img_path] = preview
+                return preview
+
+        preview = TrainingImagePreview(img_path, self._crop).to_image()
+        self._put(img_path, preview)
+        return preview
+
+    def prefetch(self, img_paths):
+        """ Method replaces the list of previews waiting for rendering """
+        with self._condition:
+            self._pending = [img_path for img_path in img_paths if not img_path in self._previews]
+            self._condition.notify()
+
+    def _put(self, img_path, preview):
+        with self._condition:
+            self._previews[img_path] = preview
+            while len(self._previews) > self._max_size:
+                self._previews.popitem(last=False)
+
+    def _run_worker(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                img_path = self._pending.pop(0)
+
+            try:
+                self._put(img_path, TrainingImagePreview(img_path, self._crop).to_image())
+            except Exception as error:
+                # The error is reported again if the meteorogram is displayed
+                print('Preview of %s not prefetched: %s' % (img_path, error))
+
 class EditorSize(object):
     """ Class which encapsulates internal sizes of editor's UI. """
 
@@ -300,6 +488,9 @@ class TrainingSetEditor(object):
 
     _crop_area = CropArea(65,140,180,466)
     _feature_labels = [('Snow', 'S'), ('Rain', 'R'), ('Storm', 'T'), ('Strong wind', 'W'), ('Clouds', 'C')]
+    _default_filter = 'clouds-present'
+    _low_confidence_filter = 'low-confidence'
+    _prefetch_count = 8
 
     def __init__(self, size, data_store):
         """
@@ -312,6 +503,8 @@ class TrainingSetEditor(object):
 
         self._size = size
         self._data_store = data_store        
+        self._filters = dict(builder_blueprint.accept_fn_index, all=lambda f: True)
+        self._previews = PreviewCache(self._crop_area, 2 * self._prefetch_count)
         
     def _setup(self, size):
         """ Method which does the initial setup of the UI. """
@@ -320,6 +513,7 @@ class TrainingSetEditor(object):
         self._root_window.resizable(width=False, height=False)
         
         self._setup_progress(size)
+        self._setup_filter(size)
         self._setup_image_label(size)
         self._setup_features(size)
         self._setup_next_button(size)
@@ -340,6 +534,12 @@ class TrainingSetEditor(object):
         self._total_images_count_label = Label(self._root_window, text=str(self._data_store.total_files_count))
         self._total_images_count_label.grid(row=0, column=3)                        
 
+    def _setup_filter(self, size):
+        """ Method which does the initial setup of the filter of meteorograms shown by the editor. """
+        self._filter_name = StringVar(self._root_window, value=self._default_filter)
+        filter_menu = OptionMenu(self._root_window, self._filter_name, *(sorted(self._filters.keys()) + [self._low_confidence_filter]))
+        filter_menu.grid(row=0, column=4)
+
     def _setup_image_label(self, size):
         """ Method which does the initial setup of meteorogram preview image. """
         self._label = Label(self._root_window, width=size.content_width)
@@ -393,7 +593,7 @@ class TrainingSetEditor(object):
             self._data_store.dump_index()
         
         try:
-            next_index = self._get_next_accepted_item(builder_blueprint.accept_fn_index['clouds-present'])
+            next_index = self._find_next_index(self._get_next_item_index())
             self._current_training_input = self._data_store.get_training_input(next_index)
             self._show_image(self._current_training_input)
             self._update_progess_labels()
@@ -406,30 +606,41 @@ class TrainingSetEditor(object):
         newIndex = int(re.sub('[^0-9]','', inputString))
         return newIndex if newIndex != self._data_store.current_file_index else newIndex+1
 
-    def _get_next_accepted_item(self, accept_fn):
-        index = self._get_next_item_index()
-        while True:                        
-            input = self._data_store.get_training_input(index)            
-            if accept_fn(input.features.label):
-                return index
-            else:
-                index += 1
+    def _find_next_index(self, index):
+        """ Method returns the index of the first meteorogram at or after the index which passes the selected filter """
+        filter_name = self._filter_name.get()
+        if filter_name == self._low_confidence_filter:
+            return self._data_store.next_low_confidence_index(index)
+        return self._data_store.next_accepted_index(index, self._filters[filter_name])
 
     def _show_image(self, training_input):
         """ Method displays the next meteorogram image. """
-        self._current_preview = TrainingImagePreview(training_input.path, self._crop_area)
-        self._current_preview.save(self._data_store.preview_path)        
         self._update_feature_buttons_binding()
 
-        img = ImageTk.PhotoImage(Image.open(self._data_store.preview_path))        
+        img = ImageTk.PhotoImage(self._previews.get(training_input.path))
         self._label.configure(image=img)
         self._label.image = img        
+        self._prefetch_previews()
+
+    def _prefetch_previews(self):
+        """ Method requests previews of the next meteorograms accepted by the current filter. """
+        img_paths = []
+        index = self._data_store.current_file_index + 1
+        try:
+            while len(img_paths) < self._prefetch_count:
+                index = self._find_next_index(index)
+                img_paths.append(self._data_store.image_path(index))
+                index += 1
+        except ValueError:
+            pass
+        self._previews.prefetch(img_paths)
 
     def activate(self):
         """ Method displays editor's window on the screen. """       
         self._setup(self._size)
         self._show_image(self._current_training_input)
         self._root_window.mainloop()
+        self._data_store.close()
 
 # Execution section
 if __name__ == "__main__":
@@ -437,11 +648,11 @@ if __name__ == "__main__":
     # HELP
     # python2.7 editor.py input_path output_path
     # python2.7 editor.py ../data/training-images ../data/training-set-index.json
+    # python2.7 editor.py ../data/training-images ../data/training-set-index.sqlite
     
     input_path = sys.argv[1]
     output_path = sys.argv[2]
-    preview_path = os.path.join(input_path, 'tmp-preview.png')
 
-    dataStore = TrainingDataStore(input_path, output_path, preview_path)
+    dataStore = TrainingDataStore(input_path, output_path)
     editor = TrainingSetEditor(EditorSize(630, 660), dataStore)
     editor.activate()
\ No newline at end of file
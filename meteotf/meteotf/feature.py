@@ -1,5 +1,7 @@
 import os
+import json
 import types
+import numpy as np
 import tensorflow as tf
 import tensorflow.train as tft
 import tensorflow.compat as tfc
@@ -17,16 +19,65 @@ def _get_tf_class(class_dir):
     class_name = str(os.path.basename(class_dir).split('_')[0])    
     return class_label, class_name
 
+""" Name of the file describing a set of TFRecord files produced by the builder """
+record_set_filename = 'records.json'
+
+def save_record_set(records_dir, record_set):
+    with open(os.path.join(records_dir, record_set_filename), 'w') as outfile:
+        json.dump(record_set, outfile, indent=4, separators=(',', ':'), sort_keys=True)
+
+def load_record_set(records_dir):
+    """
+    Returns:
+        dict: description of TFRecord files in records_dir (compression, record format and names of training and validation files).
+    """
+    record_set_path = os.path.join(records_dir, record_set_filename)
+    if not os.path.exists(record_set_path):
+        # Records built before sharding was introduced
+        return { 'compression': '', 'format': 'jpeg', 'training': ['training.TFRecord'], 'validation': ['validation.TFRecord'] }
+
+    with open(record_set_path) as infile:
+        record_set = json.load(infile)
+        record_set.setdefault('format', 'jpeg')
+        return record_set
+
+def get_n_classes(labels):
+    """
+    Args:
+        labels (iterable): labels of the examples a model is trained on.
+
+    Returns:
+        int: Number of classes of the model, at least 2 as required by the classifier.
+    """
+    return max(max(int(label) for label in labels) + 1, 2)
+
+def get_record_set_n_classes(record_set):
+    """
+    Returns:
+        int: Number of classes of the examples in the record set, 3 for records which don't describe their split.
+    """
+    classes = record_set.get('split', {}).get('classes')
+    return get_n_classes(classes) if classes else 3
+
 input_width = 90
 input_height = 42
 input_channels = 1
 input_shape = [input_width * input_height * input_channels]
 
+""" Examples store either JPEG encoded images or raw uint8 pixel buffers """
+record_formats = ['jpeg', 'raw']
+
 feature_spec = {
   'image/label': tf.FixedLenFeature([], tf.int64),
   'image/encoded': tf.FixedLenFeature([], tf.string),
 }
 
+raw_feature_spec = dict(feature_spec, **{
+  'image/height': tf.FixedLenFeature([], tf.int64),
+  'image/width': tf.FixedLenFeature([], tf.int64),
+  'image/channels': tf.FixedLenFeature([], tf.int64),
+})
+
 feature_columns = [
   tf.feature_column.numeric_column('image/encoded', shape=input_shape)
 ]
@@ -37,12 +88,72 @@ def create_example(image_path):
     image_data = open(image_path, 'rb').read()
     class_label, class_name = _get_tf_class(os.path.split(image_path)[0])
 
+    return create_encoded_example(image_data, class_label)
+
+def create_encoded_example(image_data, class_label):
+    assert type(image_data) is types.StringType, 'image_data: passed object of incorrect type'
+    assert type(class_label) is types.IntType, 'class_label: passed object of incorrect type'
+
     return tft.Example(features=tft.Features(feature={                 
         'image/label': _int64_feature(class_label),        
         'image/encoded': _bytes_feature(tfc.as_bytes(image_data)),
     }))
 
+def create_raw_example(pixels, class_label):
+    """
+    Args:
+        pixels (ndarray): uint8 image of input_height x input_width (x input_channels) pixels.
+        class_label (int): class of the example.
+    """
+    assert pixels.dtype == np.uint8, 'pixels: passed object of incorrect type'
+    assert type(class_label) is types.IntType, 'class_label: passed object of incorrect type'
+
+    height, width = pixels.shape[:2]
+    channels = pixels.shape[2] if pixels.ndim > 2 else 1
+
+    return tft.Example(features=tft.Features(feature={
+        'image/label': _int64_feature(class_label),
+        'image/encoded': _bytes_feature(tfc.as_bytes(pixels.tostring())),
+        'image/height': _int64_feature(height),
+        'image/width': _int64_feature(width),
+        'image/channels': _int64_feature(channels),
+    }))
+
+def get_record_parser(record_format):
+    """
+    Returns:
+        function: parser of serialized examples stored in the record_format.
+    """
+    assert record_format in record_formats, 'record_format: unsupported format %s' % (record_format)
+    return parse_raw_record if record_format == 'raw' else parse_record
+
 # Input function
+def parse_record_batch(records, record_format='jpeg'):
+    """
+    Vectorized parser of a batch of serialized examples stored in the record_format.
+    """
+    assert record_format in record_formats, 'record_format: unsupported format %s' % (record_format)
+
+    if record_format == 'raw':
+        parsed = tf.parse_example(records, raw_feature_spec)
+        images = tf.decode_raw(parsed['image/encoded'], tf.uint8)
+    else:
+        parsed = tf.parse_example(records, feature_spec)
+        images = tf.map_fn(tf.image.decode_jpeg, parsed['image/encoded'], dtype=tf.uint8)
+
+    images = tf.reshape(images, [-1] + input_shape)
+    labels = tf.cast(parsed['image/label'], tf.int64)
+
+    return { 'image/encoded': images }, labels
+
+def parse_raw_record(record):
+    parsed = tf.parse_single_example(record, raw_feature_spec)
+    image = tf.decode_raw(parsed['image/encoded'], tf.uint8)
+    image = tf.reshape(image, input_shape)
+    label = tf.cast(parsed['image/label'], tf.int64)
+
+    return { 'image/encoded': image }, label
+
 def parse_record(record):        
     parsed = tf.parse_single_example(record, feature_spec)
     image = tf.image.decode_jpeg(parsed['image/encoded'])
@@ -0,0 +1,409 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+
+from manifest import write_atomically
+from types import StringType
+
+""" Extensions of index files stored in the SQLite backend, any other file is a json index """
+sqlite_extensions = ['.sqlite', '.db']
+
+class JSONFeatureIndex(object):
+    """
+    Feature index stored as a single json file (sorted_keys, values and optional active_index).
+    The whole index is kept in memory and the file is rewritten on every save.
+
+    Every label update is appended to a journal next to the index before it's applied, and the journal is
+    replayed when the index is loaded, so labels assigned since the last save survive a crash.
+    Saving compacts the journal, it's safe to call from a background thread.
+    """
+
+    is_journaled = True
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path to the json index file, an empty index is created if it doesn't exist.
+        """
+
+        assert type(path) is StringType, 'path: passed object of incorrect type'
+
+        self.path = path
+        self.journal_path = JSONFeatureIndex.journal_path_for(path)
+        self._index = { 'sorted_keys': [], 'values': {} }
+        self._journal = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as infile:
+                self._index = json.load(infile)
+        self._replay_journal()
+
+    @staticmethod
+    def journal_path_for(path):
+        """
+        Returns:
+            str: Path of the journal of the index, e.g. ../data/training-set-index-journal.jsonl
+        """
+        return os.path.splitext(path)[0] + '-journal.jsonl'
+
+    def __len__(self):
+        return len(self._index['sorted_keys'])
+
+    def key_at(self, position):
+        return self._index['sorted_keys'][position]
+
+    def get_label(self, key):
+        """
+        Returns:
+            str: Label of the meteorogram or None if it wasn't categorized yet.
+        """
+        return self._index['values'].get(key)
+
+    def set_label(self, key, label):
+        """ Method stores the label of a meteorogram, the update is flushed to the journal immediately """
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write(json.dumps({ 'key': key, 'label': label }) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._index['values'][key] = label
+
+    def append_keys(self, keys):
+        self._index['sorted_keys'].extend(keys)
+
+    def labeled_items(self):
+        """
+        Returns:
+            list: (key, label) pairs of all the categorized meteorograms, in the index order.
+        """
+        values = self._index['values']
+        return [(key, values[key]) for key in self._index['sorted_keys'] if key in values]
+
+    def items(self):
+        """
+        Returns:
+            list: (key, label) pairs of all the meteorograms in the index order, label is None if not categorized yet.
+        """
+        values = self._index['values']
+        return [(key, values.get(key)) for key in self._index['sorted_keys']]
+
+    def keys_with_feature(self, feature):
+        """
+        Returns:
+            list: Keys of meteorograms which have the feature (e.g. C) in their labels, in the index order.
+        """
+        values = self._index['values']
+        return [key for key in self._index['sorted_keys'] if feature in values.get(key, '')]
+
+    def first_unlabeled_position(self):
+        """
+        Returns:
+            int: Position of the first meteorogram which wasn't categorized yet, len(index) if all of them were.
+        """
+        position = 0
+        for key in self._index['sorted_keys']:
+            if not key in self._index['values']:
+                break
+            position += 1
+        return position
+
+    @property
+    def active_index(self):
+        return self._index.get('active_index')
+
+    @active_index.setter
+    def active_index(self, value):
+        self._index['active_index'] = value
+
+    def to_dict(self):
+        return self._index
+
+    def load_dict(self, index):
+        """ Method replaces the content of the index with a dict in the json index format """
+        with self._lock:
+            self._index = index
+            self._replace_journal('')
+
+    def save(self):
+        """
+        Method atomically rewrites the index file with a snapshot of the index
+        and removes the journaled updates which are already included in the snapshot.
+        """
+        with self._save_lock:
+            with self._lock:
+                index = dict(self._index, sorted_keys=list(self._index['sorted_keys']), values=dict(self._index['values']))
+                if self._journal is not None:
+                    self._journal.flush()
+                journal_size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+
+            write_atomically(self.path, json.dumps(index, indent=4, separators=(',', ':')), fsync=True)
+
+            with self._lock:
+                if os.path.exists(self.journal_path):
+                    with open(self.journal_path) as infile:
+                        infile.seek(journal_size)
+                        self._replace_journal(infile.read())
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+
+        updates = []
+        interrupted = False
+        with open(self.journal_path) as infile:
+            for line in infile:
+                try:
+                    update = json.loads(line)
+                except ValueError:
+                    interrupted = True # the last update was interrupted by a crash
+                    break
+                self._index['values'][update['key']] = update['label']
+                updates.append(json.dumps(update) + '\n')
+                interrupted = not line.endswith('\n')
+
+        # Later updates can't be appended to an interrupted line
+        if interrupted:
+            self._replace_journal(''.join(updates))
+
+    def _replace_journal(self, content):
+        """ Method atomically replaces the content of the journal, it has to be called with the lock acquired """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        if len(content) == 0:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return
+
+        write_atomically(self.journal_path, content)
+
+class SQLiteFeatureIndex(object):
+    """
+    Feature index stored in an SQLite database in the WAL mode.
+    Every label update is a single indexed write, so the cost of categorizing a meteorogram doesn't depend on the size of the index.
+    Letters of every label are stored in a separate table, so meteorograms with a given feature are found without a full scan.
+    """
+
+    is_journaled = False
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS meteorograms (position INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, label TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS features (feature TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (feature, key));
+        CREATE INDEX IF NOT EXISTS features_key ON features (key);
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path to the database file, an empty index is created if it doesn't exist.
+        """
+
+        assert type(path) is StringType, 'path: passed object of incorrect type'
+
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self._schema)
+
+    def __len__(self):
+        # Positions are contiguous, so the last one is found in the primary key without counting all the rows
+        count = self._connection.execute('SELECT MAX(position) + 1 FROM meteorograms').fetchone()[0]
+        return count or 0
+
+    def key_at(self, position):
+        if position < 0:
+            position += len(self)
+        row = self._connection.execute('SELECT key FROM meteorograms WHERE position = ?', (position,)).fetchone()
+        if row is None:
+            raise IndexError('index position out of range')
+        return row[0]
+
+    def get_label(self, key):
+        """
+        Returns:
+            str: Label of the meteorogram or None if it wasn't categorized yet.
+        """
+        row = self._connection.execute('SELECT label FROM labels WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_label(self, key, label):
+        """ Method stores the label of a meteorogram, the change is committed immediately """
+        with self._connection:
+            self._write_label(key, label)
+
+    def append_keys(self, keys):
+        with self._connection:
+            self._write_keys(len(self), keys)
+
+    def labeled_items(self):
+        """
+        Returns:
+            list: (key, label) pairs of all the categorized meteorograms, in the index order.
+        """
+        return self._connection.execute(
+            'SELECT m.key, l.label FROM meteorograms m JOIN labels l ON l.key = m.key ORDER BY m.position'
+        ).fetchall()
+
+    def items(self):
+        """
+        Returns:
+            list: (key, label) pairs of all the meteorograms in the index order, label is None if not categorized yet.
+        """
+        return self._connection.execute(
+            'SELECT m.key, l.label FROM meteorograms m LEFT JOIN labels l ON l.key = m.key ORDER BY m.position'
+        ).fetchall()
+
+    def keys_with_feature(self, feature):
+        """
+        Returns:
+            list: Keys of meteorograms which have the feature (e.g. C) in their labels, in the index order.
+        """
+        rows = self._connection.execute(
+            'SELECT m.key FROM features f JOIN meteorograms m ON m.key = f.key WHERE f.feature = ? ORDER BY m.position',
+            (feature,)
+        )
+        return [row[0] for row in rows]
+
+    def first_unlabeled_position(self):
+        """
+        Returns:
+            int: Position of the first meteorogram which wasn't categorized yet, len(index) if all of them were.
+        """
+        position = self._connection.execute(
+            'SELECT MIN(m.position) FROM meteorograms m LEFT JOIN labels l ON l.key = m.key WHERE l.key IS NULL'
+        ).fetchone()[0]
+        return len(self) if position is None else position
+
+    @property
+    def active_index(self):
+        row = self._connection.execute('SELECT value FROM metadata WHERE name = ?', ('active_index',)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @active_index.setter
+    def active_index(self, value):
+        with self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?)', ('active_index', json.dumps(value)))
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Content of the index in the json index format.
+        """
+        index = {
+            'sorted_keys': [row[0] for row in self._connection.execute('SELECT key FROM meteorograms ORDER BY position')],
+            'values': dict(self._connection.execute('SELECT key, label FROM labels')),
+        }
+        active_index = self.active_index
+        if active_index is not None:
+            index['active_index'] = active_index
+        return index
+
+    def load_dict(self, index):
+        """ Method replaces the content of the index with a dict in the json index format """
+        with self._connection:
+            for table in ['meteorograms', 'labels', 'features', 'metadata']:
+                self._connection.execute('DELETE FROM %s' % (table))
+
+            self._write_keys(0, index['sorted_keys'])
+            for key, label in index['values'].items():
+                self._write_label(key, label)
+            if 'active_index' in index:
+                self._connection.execute(
+                    'INSERT INTO metadata VALUES (?, ?)', ('active_index', json.dumps(index['active_index']))
+                )
+
+    def save(self):
+        """ Every change is already committed, method is kept for compatibility with the json index """
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def _write_keys(self, first_position, keys):
+        self._connection.executemany(
+            'INSERT INTO meteorograms (position, key) VALUES (?, ?)',
+            ((first_position + offset, key) for offset, key in enumerate(keys))
+        )
+
+    def _write_label(self, key, label):
+        self._connection.execute('INSERT OR REPLACE INTO labels (key, label) VALUES (?, ?)', (key, label))
+        self._connection.execute('DELETE FROM features WHERE key = ?', (key,))
+        self._connection.executemany(
+            'INSERT INTO features (feature, key) VALUES (?, ?)', ((feature, key) for feature in set(label))
+        )
+
+def suggestions_path_for(index_path):
+    """
+    Returns:
+        str: Path of the labels suggested by a model for the index, e.g. ../data/training-set-index-suggestions.json
+    """
+    return os.path.splitext(index_path)[0] + '-suggestions.json'
+
+def load_suggestions(index_path):
+    """
+    Returns:
+        dict: Suggested label and its confidence ({ 'label': 'RC', 'confidence': 0.93 }) by meteorogram key,
+            empty if there are no suggestions for the index.
+    """
+    suggestions_path = suggestions_path_for(index_path)
+    if not os.path.exists(suggestions_path):
+        return {}
+
+    with open(suggestions_path) as infile:
+        return json.load(infile)
+
+def save_suggestions(index_path, suggestions):
+    """ Method atomically stores suggested labels next to the index """
+    write_atomically(suggestions_path_for(index_path), json.dumps(suggestions, indent=4, separators=(',', ':'), sort_keys=True))
+
+def open_feature_index(path):
+    """
+    Returns:
+        JSONFeatureIndex or SQLiteFeatureIndex: Index stored in the backend matching the file's extension.
+    """
+    if os.path.splitext(path)[1] in sqlite_extensions:
+        return SQLiteFeatureIndex(path)
+    return JSONFeatureIndex(path)
+
+def convert_feature_index(source_path, destination_path):
+    """ Method copies the content of an index to an index stored in another backend, e.g. json to SQLite """
+    source = open_feature_index(source_path)
+    destination = open_feature_index(destination_path)
+    try:
+        destination.load_dict(source.to_dict())
+        destination.save()
+    finally:
+        source.close()
+        destination.close()
+
+# Execution section
+if __name__ == "__main__":
+
+    # HELP
+    # python2.7 featureindex.py source_path destination_path
+    # python2.7 featureindex.py ../data/training-set-index.json ../data/training-set-index.sqlite
+    # python2.7 featureindex.py ../data/training-set-index.sqlite ../data/training-set-index.json
+
+    source_path = sys.argv[1]
+    destination_path = sys.argv[2]
+
+    if not os.path.exists(source_path):
+        raise ValueError('File or directory %s does not exists' % (source_path))
+
+    convert_feature_index(source_path, destination_path)
+    print('Index %s converted to %s' % (source_path, destination_path))
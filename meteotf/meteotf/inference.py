@@ -0,0 +1,217 @@
+import os
+import feature
+import itertools
+import numpy as np
+import tensorflow as tf
+import builder_blueprint
+
+from builder import MeteorogramImage, get_item_label
+from editor import CropArea
+from types import StringType
+
+""" Input of the frozen graph behind the parsing of serialized examples, it takes float pixels of a batch of examples """
+input_tensor_name = 'dnn/input_from_feature_columns/input_layer/image/encoded/ToFloat:0'
+
+""" Class probabilities of the examples """
+output_tensor_name = 'dnn/head/predictions/probabilities:0'
+
+""" Name of the frozen graph stored by MeteoMLModel.save in the exported model directory """
+frozen_graph_filename = 'frozen_model.pb'
+
+""" Order of the features in labels composed of predictions, the same as in labels assigned by the editor """
+label_features = 'SRTWC'
+
+class FrozenModelPredictor(object):
+    """
+    Class which runs predictions of a frozen MeteoMLModel graph.
+    The graph is loaded once, examples are fed as decoded pixels, so any number of them is predicted in a single run.
+    """
+
+    def __init__(self, model_path, session_config=None):
+        """
+        Args:
+            model_path (str): path to the frozen graph or to the exported model directory which contains it.
+            session_config (ConfigProto): configuration of the session, e.g. thread pool sizes.
+        """
+
+        assert type(model_path) is StringType, 'model_path: passed object of incorrect type'
+
+        if os.path.isdir(model_path):
+            model_path = os.path.join(model_path, frozen_graph_filename)
+        if not os.path.exists(model_path):
+            raise ValueError('File or directory %s does not exists' % (model_path))
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(model_path, 'rb') as infile:
+            graph_def.ParseFromString(infile.read())
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._input = self._graph.get_tensor_by_name(input_tensor_name)
+        self._output = self._graph.get_tensor_by_name(output_tensor_name)
+        self._session = tf.Session(graph=self._graph, config=session_config)
+
+    @property
+    def n_classes(self):
+        return int(self._output.shape[-1])
+
+    def predict(self, pixels):
+        """
+        Args:
+            pixels (ndarray): uint8 examples, either images of input_height x input_width pixels or flat input_shape vectors.
+
+        Returns:
+            ndarray: class probabilities of every example, batch size x n_classes.
+        """
+        pixels = np.asarray(pixels).reshape([-1] + feature.input_shape)
+        return self._session.run(self._output, { self._input: pixels.astype(np.float32) })
+
+    def close(self):
+        self._session.close()
+
+class BlueprintClassifier(object):
+    """
+    Class which classifies meteorograms with a model trained on examples of a blueprint.
+    Every crop area of the blueprint is classified only among the classes cut out of that area,
+    the predicted classes are translated to features (e.g. W) of the blueprint items.
+    """
+
+    def __init__(self, blueprint_name, predictor):
+        """
+        Args:
+            blueprint_name (str): name of the blueprint in builder_blueprint.index.
+            predictor (FrozenModelPredictor): predictor of the model trained on the blueprint, or any object with the same predict method.
+        """
+
+        assert type(blueprint_name) is StringType, 'blueprint_name: passed object of incorrect type'
+
+        self.blueprint_name = blueprint_name
+        self.crop_areas = []
+        self._classes = []
+        for item in builder_blueprint.index[blueprint_name](''):
+            crop_area = get_crop_area_tuple(item['crop_area'])
+            if not crop_area in self.crop_areas:
+                self.crop_areas.append(crop_area)
+                self._classes.append([])
+            self._classes[self.crop_areas.index(crop_area)].append((get_item_label(item), item['class_name'], item['features']))
+
+        self._predictor = predictor
+
+    @property
+    def class_names(self):
+        """
+        Returns:
+            list: names of the classes predicted in every crop area, in the order of classify's probabilities.
+        """
+        return [class_name for classes in self._classes for _, class_name, _ in classes]
+
+    def classify(self, crops):
+        """
+        Args:
+            crops (list): batch of examples of every crop area (in the crop_areas order).
+
+        Returns:
+            list: (features, confidence, probabilities) of every meteorogram in the batch. Confidence is the lowest
+                probability of the predicted classes, probabilities are listed in the class_names order.
+        """
+        batch_size = len(crops[0])
+        features = [''] * batch_size
+        confidence = np.ones(batch_size)
+        probabilities = []
+
+        for area_crops, classes in zip(crops, self._classes):
+            area_probabilities = normalize_probabilities(self._predictor.predict(area_crops)[:, [label for label, _, _ in classes]])
+            best_classes = np.argmax(area_probabilities, axis=1)
+
+            for example, best_class in enumerate(best_classes):
+                features[example] += classes[best_class][2]
+            confidence = np.minimum(confidence, area_probabilities[np.arange(batch_size), best_classes])
+            probabilities.append(area_probabilities)
+
+        probabilities = np.concatenate(probabilities, axis=1)
+        return [(features[example], float(confidence[example]), probabilities[example].tolist()) for example in range(batch_size)]
+
+    def classify_crops(self, crops):
+        """
+        Classifies examples of an unknown crop area among the classes of all crop areas, for blueprints
+        with a single crop area the probabilities are the same as the ones of classify.
+
+        Args:
+            crops (list): batch of examples.
+
+        Returns:
+            list: (class name, confidence, probabilities) of every example, probabilities are listed in the class_names order.
+        """
+        classes = [item for area_classes in self._classes for item in area_classes]
+        probabilities = normalize_probabilities(self._predictor.predict(crops)[:, [label for label, _, _ in classes]])
+        best_classes = np.argmax(probabilities, axis=1)
+        return [
+            (classes[best_class][1], float(probabilities[example, best_class]), probabilities[example].tolist())
+            for example, best_class in enumerate(best_classes)
+        ]
+
+    def close(self):
+        self._predictor.close()
+
+def normalize_probabilities(probabilities):
+    """
+    Returns:
+        ndarray: probabilities of a subset of the model's classes scaled to sum to one for every example.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    return probabilities / np.maximum(probabilities.sum(axis=1, keepdims=True), 1e-12)
+
+def get_class_names(blueprint_name):
+    """
+    Returns:
+        list: names of the blueprint's classes ordered by their labels, the order of the model's probabilities.
+    """
+    return [item['class_name'] for item in sorted(builder_blueprint.index[blueprint_name](''), key=get_item_label)]
+
+def get_crop_area_tuple(crop_area):
+    """
+    Returns:
+        tuple: (x, y, width, height) of the crop area, e.g. to pass it to another process.
+    """
+    return (crop_area.x, crop_area.y, crop_area.width, crop_area.height)
+
+def crop_meteorogram(img_path, crop_areas):
+    """
+    Returns:
+        list: pixels of the training example cut out of every (x, y, width, height) crop area,
+            or None if the meteorogram can't be decoded.
+    """
+    try:
+        image = MeteorogramImage(img_path)
+    except ValueError:
+        return None
+    return [image.crop(CropArea(*crop_area)).pixels for crop_area in crop_areas]
+
+def crop_task(task):
+    """
+    Args:
+        task (tuple): key, path and (x, y, width, height) crop areas of a meteorogram.
+
+    Returns:
+        tuple: key and the result of crop_meteorogram, the function can be passed to a process pool.
+    """
+    key, img_path, crop_areas = task
+    return key, crop_meteorogram(img_path, crop_areas)
+
+def iter_batches(items, batch_size):
+    """ Generator of lists of at most batch_size consecutive items """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def compose_label(features):
+    """
+    Returns:
+        str: label in the editor's format composed of the predicted features, U if no features were predicted.
+    """
+    label = ''.join(feature_sign for feature_sign in label_features if feature_sign in features)
+    return label if len(label) > 0 else 'U'
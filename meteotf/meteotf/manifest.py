@@ -0,0 +1,195 @@
+import os
+import json
+import stat
+import hashlib
+import tempfile
+import threading
+
+from types import StringType
+
+class DirectoryManifest(object):
+    """
+    Class which keeps an index of meteorogram files stored in a directory.
+    The index is persisted as a json file next to the directory, so the downloader, the editor
+    and the builder can check which meteorograms are available without stat'ing every single file.
+
+    Every entry of the manifest contains the file's size, modification time and md5 checksum.
+    """
+
+    def __init__(self, directory, manifest_path=None):
+        """
+        Args:
+            directory (str): Path to the directory which contains meteorograms.
+            manifest_path (str): Path to the manifest file, by default it's stored next to the directory.
+        """
+
+        assert type(directory) is StringType, 'directory: passed object of incorrect type'
+
+        self._directory = directory
+        self.path = manifest_path or DirectoryManifest.path_for(directory)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        if self.exists:
+            with open(self.path) as infile:
+                self._entries = json.load(infile)
+
+    @staticmethod
+    def path_for(directory):
+        """
+        Returns:
+            str: Path of the manifest file of the directory, e.g. ../data/training-images-manifest.json
+        """
+        return os.path.normpath(directory) + '-manifest.json'
+
+    @property
+    def exists(self):
+        """
+        Returns:
+            bool: True if the manifest was already persisted.
+        """
+        return os.path.exists(self.path)
+
+    @property
+    def filenames(self):
+        """
+        Returns:
+            set: Names of all the files listed in the manifest.
+        """
+        with self._lock:
+            return set(self._entries.keys())
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def get(self, filename):
+        """
+        Returns:
+            dict: Entry of the file (size, mtime, checksum) or None if the file is not in the manifest.
+        """
+        return self._entries.get(filename)
+
+    def sync(self):
+        """
+        Method updates the manifest with a single listing of the directory, files which appeared are added
+        and files which disappeared are removed. Only the new files are stat'ed, entries of the others are kept as they are.
+
+        Returns:
+            bool: True if any entry was added or removed.
+        """
+        if not os.path.exists(self._directory):
+            return False
+
+        present = set(filename for filename in os.listdir(self._directory) if not filename.startswith('.'))
+
+        with self._lock:
+            removed_files = set(self._entries.keys()) - present
+            for filename in removed_files:
+                del self._entries[filename]
+            new_files = present - set(self._entries.keys())
+
+        added_files = 0
+        for filename in new_files:
+            file_stat = os.stat(os.path.join(self._directory, filename))
+            if stat.S_ISREG(file_stat.st_mode):
+                self._put_file(filename, file_stat)
+                added_files += 1
+
+        return len(removed_files) + added_files > 0
+
+    def refresh(self, filenames):
+        """
+        Method checks whether the listed files changed since they were put into the manifest, with a single stat per file.
+        Files which size or modification time changed are checksummed again, files which are gone are removed.
+
+        Args:
+            filenames (iterable): names of the files which are checked, names missing in the manifest are skipped.
+
+        Returns:
+            bool: True if any entry was updated or removed.
+        """
+        changed = False
+        for filename in filenames:
+            entry = self.get(filename)
+            if entry is None:
+                continue
+
+            try:
+                file_stat = os.stat(os.path.join(self._directory, filename))
+            except OSError:
+                file_stat = None
+
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                self.remove(filename)
+                changed = True
+            elif entry['size'] != file_stat.st_size or entry['mtime'] != file_stat.st_mtime:
+                self._put_file(filename, file_stat)
+                changed = True
+        return changed
+
+    def add_file(self, filename, checksum=None):
+        """
+        Method puts an existing file into the manifest.
+
+        Args:
+            filename (str): Name of the file in the directory.
+            checksum (str): md5 checksum of the file, calculated if not passed.
+        """
+        self._put_file(filename, os.stat(os.path.join(self._directory, filename)), checksum)
+
+    def _put_file(self, filename, file_stat, checksum=None):
+        checksum = checksum or file_checksum(os.path.join(self._directory, filename))
+
+        with self._lock:
+            self._entries[filename] = {
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime,
+                'checksum': checksum,
+            }
+
+    def remove(self, filename):
+        with self._lock:
+            self._entries.pop(filename, None)
+
+    def save(self):
+        """ Method atomically saves the manifest next to the directory """
+        with self._lock:
+            entries = dict(self._entries)
+
+        write_atomically(self.path, json.dumps(entries, indent=4, separators=(',', ':'), sort_keys=True))
+
+def write_atomically(path, data, fsync=False):
+    """
+    Method writes data into a temporary file next to path and renames it to path,
+    so readers never see a partially written file.
+
+    Args:
+        path (str): path of the written file.
+        data (str): content of the file.
+        fsync (bool): flush the content to the disk before the file is renamed.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    mode = os.stat(path).st_mode & 0777 if os.path.exists(path) else 0644
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        os.fchmod(file_descriptor, mode) # mkstemp creates files readable only by the owner
+        with os.fdopen(file_descriptor, 'wb') as outfile:
+            outfile.write(data)
+            if fsync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def file_checksum(path, chunk_size=64 * 1024):
+    """
+    Returns:
+        str: md5 checksum of the file.
+    """
+    checksum = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
@@ -0,0 +1,170 @@
+import os
+import cv2
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+import feature
+import tensorflow as tf
+
+from benchmark import save_report
+from builder import MeteoTrainingRecordWriter
+from trainer import MeteoMLModel, InputPipelineConfig
+
+""" Input pipeline configurations measured by default """
+default_configurations = [
+    { 'format': 'jpeg', 'parallel_calls': 1, 'prefetch': 0, 'cache': None },
+    { 'format': 'jpeg', 'parallel_calls': 4, 'prefetch': 2, 'cache': None },
+    { 'format': 'jpeg', 'parallel_calls': 4, 'prefetch': 2, 'cache': '' },
+    { 'format': 'raw', 'parallel_calls': 1, 'prefetch': 0, 'cache': None },
+    { 'format': 'raw', 'parallel_calls': 4, 'prefetch': 2, 'cache': None },
+    { 'format': 'raw', 'parallel_calls': 4, 'prefetch': 2, 'cache': '' },
+]
+
+def synthetic_example_image(random_state):
+    """
+    Returns:
+        ndarray: uint8 grayscale image resembling a cropped meteorogram (smooth plot over a light background).
+    """
+    image = np.full((feature.input_height, feature.input_width), 230, dtype=np.uint8)
+    plot = np.cumsum(random_state.randint(-2, 3, feature.input_width)) + random_state.randint(5, feature.input_height - 5)
+    for x, y in enumerate(np.clip(plot, 0, feature.input_height - 1)):
+        image[y:, x] = random_state.randint(60, 120)
+    return image
+
+def build_synthetic_records(records_dir, examples_count, record_format, compression=None, seed=0):
+    """ Method writes a set of synthetic training examples compatible with feature.create_example """
+    random_state = np.random.RandomState(seed)
+    record_writer = MeteoTrainingRecordWriter(records_dir, 1.0, compression=compression, record_format=record_format)
+
+    for index in range(examples_count):
+        image = synthetic_example_image(random_state)
+        label = index % 3
+        if record_format == 'raw':
+            example = feature.create_raw_example(image, label)
+        else:
+            example = feature.create_encoded_example(cv2.imencode('.jpeg', image)[1].tostring(), label)
+        record_writer.write(example, '%010d-0-0' % (index))
+
+    record_writer.close()
+
+def measure_dataset(dataset):
+    """
+    Method iterates over the whole dataset and measures latency of every batch.
+
+    Returns:
+        dict: examples per second and batch latency statistics (in milliseconds).
+    """
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    latencies = []
+    examples = 0
+
+    with tf.Session() as session:
+        started_at = time.time()
+        while True:
+            batch_started_at = time.time()
+            try:
+                batch = session.run(next_batch)
+            except tf.errors.OutOfRangeError:
+                break
+            latencies.append(time.time() - batch_started_at)
+            examples += len(batch[1]) if isinstance(batch, tuple) else len(batch)
+        total_time = time.time() - started_at
+
+    latencies = np.array(latencies or [0.0]) * 1000
+    return {
+        'examples': examples,
+        'seconds': total_time,
+        'examples_per_second': examples / max(total_time, 1e-6),
+        'batch_latency_ms': {
+            'mean': float(np.mean(latencies)),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'max': float(np.max(latencies)),
+        },
+    }
+
+def benchmark_configuration(records_dir, configuration, epochs, batch_size, model_dir):
+    """
+    Method measures stages of the input pipeline in the given configuration:
+
+    - read: reading serialized examples from the record shards,
+    - parse: reading and parsing batches of examples,
+    - pipeline: the whole MeteoMLModel input pipeline.
+    """
+    record_set = feature.load_record_set(records_dir)
+    record_files = [os.path.join(records_dir, filename) for filename in record_set['training']]
+    compression = record_set['compression']
+    results = {}
+
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset(record_files, compression_type=compression).batch(batch_size)
+        results['read'] = measure_dataset(dataset)
+
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset(record_files, compression_type=compression).batch(batch_size)
+        dataset = dataset.map(lambda records: feature.parse_record_batch(records, record_set['format']))
+        results['parse'] = measure_dataset(dataset)
+
+    with tf.Graph().as_default():
+        pipeline_config = InputPipelineConfig(
+            batch_size=batch_size,
+            parallel_calls=configuration['parallel_calls'],
+            prefetch=configuration['prefetch'],
+            cache=configuration['cache']
+        )
+        model = MeteoMLModel(model_dir, pipeline_config)
+        dataset = model._prepare_dataset(record_files, epochs, compression, record_set['format'])
+        results['pipeline'] = measure_dataset(dataset)
+
+    return results
+
+# Execution section
+if __name__ == "__main__":
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    # HELP
+    # python2.7 pipeline_benchmark.py report_path [--examples N] [--epochs N] [--batch-size N] [--compression GZIP|ZLIB] [--configurations PATH]
+    # python2.7 pipeline_benchmark.py ../data/benchmarks/pipeline.json --examples 20000
+
+    parser = argparse.ArgumentParser(description='Measures throughput of the trainer\'s input pipeline on synthetic records')
+    parser.add_argument('report_path', help='path where the JSON report will be stored')
+    parser.add_argument('--examples', type=int, default=10000, help='number of synthetic examples')
+    parser.add_argument('--epochs', type=int, default=2, help='number of epochs read by the pipeline')
+    parser.add_argument('--batch-size', type=int, default=30, help='number of examples in a batch')
+    parser.add_argument('--compression', choices=['GZIP', 'ZLIB'], help='compression of the synthetic records')
+    parser.add_argument('--configurations', help='JSON file with a list of configurations (format, parallel_calls, prefetch, cache)')
+    args = parser.parse_args()
+
+    configurations = default_configurations
+    if args.configurations:
+        with open(args.configurations) as infile:
+            configurations = json.load(infile)
+
+    work_dir = tempfile.mkdtemp(prefix='pipeline-benchmark-')
+    try:
+        results = []
+        for record_format in feature.record_formats:
+            records_dir = os.path.join(work_dir, record_format)
+            os.makedirs(records_dir)
+            build_synthetic_records(records_dir, args.examples, record_format, args.compression)
+
+        for configuration in configurations:
+            print('Benchmarking %s' % (json.dumps(configuration, sort_keys=True)))
+            records_dir = os.path.join(work_dir, configuration['format'])
+            stages = benchmark_configuration(records_dir, configuration, args.epochs, args.batch_size, os.path.join(work_dir, 'model'))
+            results.append({ 'configuration': configuration, 'stages': stages })
+            print('  %.1f examples/s' % (stages['pipeline']['examples_per_second']))
+
+        save_report(args.report_path, {
+            'examples': args.examples,
+            'epochs': args.epochs,
+            'batch_size': args.batch_size,
+            'compression': args.compression or '',
+            'results': results,
+        })
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,180 @@
+import os
+import cv2
+import csv
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+import feature
+import builder_blueprint
+import tensorflow as tf
+
+from builder import get_record_options, decode_raw_example
+from inference import BlueprintClassifier, FrozenModelPredictor, compose_label, crop_task, get_class_names, iter_batches, normalize_probabilities
+from types import StringType
+
+class PredictionWriter(object):
+    """
+    Class which streams predictions to a CSV file, or to a JSON lines file if the path has any other extension.
+    Every batch of rows is flushed, so only the current batch is kept in memory.
+    """
+
+    def __init__(self, output_path, fields):
+        """
+        Args:
+            output_path (str): path of the output file, e.g. predictions.csv or predictions.jsonl.
+            fields (list): names of the columns.
+        """
+
+        assert type(output_path) is StringType, 'output_path: passed object of incorrect type'
+
+        self._fields = fields
+        self._outfile = open(output_path, 'wb')
+        self._csv_writer = None
+        if os.path.splitext(output_path)[1] == '.csv':
+            self._csv_writer = csv.writer(self._outfile)
+            self._csv_writer.writerow(fields)
+
+    def write(self, rows):
+        """ Method writes a batch of rows, every row is a list of values in the fields order """
+        for row in rows:
+            if self._csv_writer:
+                self._csv_writer.writerow(row)
+            else:
+                self._outfile.write(json.dumps(dict(zip(self._fields, row)), sort_keys=True) + '\n')
+        self._outfile.flush()
+
+    def close(self):
+        self._outfile.close()
+
+def iter_cropped_batches(pool, tasks, batch_size):
+    """
+    Generator of batches of cropped meteorograms. The next batch is cropped by the pool while the current one is classified,
+    so at most two batches are kept in memory.
+    """
+    pending = None
+    for batch in iter_batches(tasks, batch_size):
+        cropped = pool.map_async(crop_task, batch) if pool else itertools.imap(crop_task, batch)
+        if pending is not None:
+            yield list(pending.get() if pool else pending)
+        pending = cropped
+    if pending is not None:
+        yield list(pending.get() if pool else pending)
+
+def predict_images(classifier, images_dir, batch_size, pool=None):
+    """
+    Generator of predictions of all the meteorograms in a directory.
+
+    Returns:
+        generator: batches of (key, label, confidence, probability of every class) rows.
+    """
+    keys = sorted(os.path.splitext(filename)[0] for filename in os.listdir(images_dir) if filename.endswith('.png'))
+    tasks = ((key, os.path.join(images_dir, key + '.png'), classifier.crop_areas) for key in keys)
+
+    for batch in iter_cropped_batches(pool, tasks, batch_size):
+        for key, crops in batch:
+            if crops is None:
+                print('Unable to decode meteorogram %s' % (key))
+
+        batch = [(key, crops) for key, crops in batch if crops is not None]
+        if len(batch) == 0:
+            continue
+
+        crops = [np.stack([crops[area] for _, crops in batch]) for area in range(len(classifier.crop_areas))]
+        yield [
+            [key, compose_label(features), confidence] + probabilities
+            for (key, _), (features, confidence, probabilities) in zip(batch, classifier.classify(crops))
+        ]
+
+def iter_records(records_dir, record_sets):
+    """ Generator of (key, expected class label, pixels) of the examples stored in the records, one record at a time """
+    record_set = feature.load_record_set(records_dir)
+    options = get_record_options(record_set['compression'])
+
+    for set_name in record_sets:
+        for filename in record_set[set_name]:
+            record_path = os.path.join(records_dir, filename)
+            for record_index, record in enumerate(tf.python_io.tf_record_iterator(record_path, options)):
+                example = tf.train.Example.FromString(record)
+                encoded_image = example.features.feature['image/encoded'].bytes_list.value[0]
+                if record_set['format'] == 'raw':
+                    pixels = decode_raw_example(encoded_image)
+                else:
+                    pixels = cv2.imdecode(np.frombuffer(encoded_image, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+                label = example.features.feature['image/label'].int64_list.value[0]
+                yield '%s:%d' % (filename, record_index), label, pixels
+
+def predict_records(predictor, class_names, records_dir, record_sets, batch_size):
+    """
+    Generator of predictions of the examples stored in the records built by the builder.
+    Probabilities of the blueprint's classes are normalized the same way as by BlueprintClassifier.
+
+    Returns:
+        generator: batches of (key, expected class, predicted class, confidence, probability of every class) rows.
+    """
+    for batch in iter_batches(iter_records(records_dir, record_sets), batch_size):
+        probabilities = normalize_probabilities(predictor.predict(np.stack([pixels for _, _, pixels in batch]))[:, :len(class_names)])
+        yield [
+            [key, class_names[label], class_names[np.argmax(example)], float(np.max(example))] + example.tolist()
+            for (key, label, _), example in zip(batch, probabilities)
+        ]
+
+# Execution section
+if __name__ == "__main__":
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    # HELP
+    # python2.7 predict.py blueprint model_path input_path output_path [--batch-size N] [--workers N] [--records-set training|validation|all]
+    # python2.7 predict.py wind ../data/wind-model/saved-models/1549906107 ../data/daily-images ../data/daily-wind.csv --workers 8
+    # python2.7 predict.py wind ../data/wind-model/saved-models/1549906107 ../data/wind-model/records ../data/wind-validation.jsonl --records-set validation
+
+    parser = argparse.ArgumentParser(description='Predicts classes of meteorograms or of examples stored in TFRecord files')
+    parser.add_argument('blueprint_name', choices=sorted(builder_blueprint.index.keys()), help='blueprint the model was trained on')
+    parser.add_argument('model_path', help='exported model directory which contains the frozen graph')
+    parser.add_argument('input_path', help='directory of meteorogram images or of TFRecord files built by the builder')
+    parser.add_argument('output_path', help='CSV (.csv) or JSON lines file where the predictions will be stored')
+    parser.add_argument('--batch-size', type=int, default=512, help='number of images predicted at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes cropping the meteorograms')
+    parser.add_argument('--records-set', choices=['training', 'validation', 'all'], default='all', help='set of TFRecord files which is predicted')
+    args = parser.parse_args()
+
+    records_mode = os.path.exists(os.path.join(args.input_path, feature.record_set_filename))
+    if not records_mode and any(filename.lower().endswith('.tfrecord') for filename in os.listdir(args.input_path)):
+        raise ValueError('%s contains records built before %s was introduced, build them again' % (args.input_path, feature.record_set_filename))
+
+    # Worker processes are forked before any session is created
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 and not records_mode else None
+
+    try:
+        if records_mode:
+            class_names = get_class_names(args.blueprint_name)
+            predictor = FrozenModelPredictor(args.model_path)
+            record_sets = ['training', 'validation'] if args.records_set == 'all' else [args.records_set]
+            writer = PredictionWriter(args.output_path, ['key', 'expected', 'predicted', 'confidence'] + class_names)
+            batches = predict_records(predictor, class_names, args.input_path, record_sets, args.batch_size)
+        else:
+            predictor = BlueprintClassifier(args.blueprint_name, FrozenModelPredictor(args.model_path))
+            writer = PredictionWriter(args.output_path, ['key', 'label', 'confidence'] + predictor.class_names)
+            batches = predict_images(predictor, args.input_path, args.batch_size, pool)
+
+        started_at = time.time()
+        processed = 0
+        for rows in batches:
+            writer.write(rows)
+            processed += len(rows)
+            sys.stdout.write('\rPredicted %d images (%.1f images/s)' % (processed, processed / max(time.time() - started_at, 1e-6)))
+            sys.stdout.flush()
+
+        writer.close()
+        predictor.close()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    elapsed = max(time.time() - started_at, 1e-6)
+    print('\nPredicted %d images in %.1fs (%.1f images/s), results stored in %s' % (processed, elapsed, processed / elapsed, args.output_path))
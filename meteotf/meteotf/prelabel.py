@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+import builder_blueprint
+
+from inference import BlueprintClassifier, FrozenModelPredictor, compose_label, crop_task, get_crop_area_tuple, iter_batches
+from featureindex import open_feature_index, load_suggestions, save_suggestions
+
+def get_unlabeled_keys(index_path):
+    """
+    Returns:
+        list: keys of all the meteorograms which weren't categorized yet, in the index order.
+    """
+    index = open_feature_index(index_path)
+    try:
+        return [key.encode('ascii','ignore') for key, label in index.items() if label is None]
+    finally:
+        index.close()
+
+def suggest_labels(cropped_meteorograms, classifiers, crop_areas, batch_size):
+    """
+    Generator of suggested labels of meteorograms, every classifier predicts whole batches of them at once.
+
+    Args:
+        cropped_meteorograms (iterable): (key, examples cut out of every crop area) pairs.
+        classifiers (list): BlueprintClassifier of every blueprint which contributes to the labels.
+        crop_areas (list): (x, y, width, height) crop areas, in the order of the examples.
+        batch_size (int): number of meteorograms classified at once.
+
+    Returns:
+        generator: (key, suggestion) pairs, suggestion is None if the meteorogram can't be decoded.
+    """
+    for batch in iter_batches(cropped_meteorograms, batch_size):
+        for key, crops in batch:
+            if crops is None:
+                yield key, None
+
+        batch = [(key, crops) for key, crops in batch if crops is not None]
+        if len(batch) == 0:
+            continue
+
+        features = [''] * len(batch)
+        confidence = [1.0] * len(batch)
+        for classifier in classifiers:
+            crops = [
+                np.stack([crops[crop_areas.index(crop_area)] for _, crops in batch])
+                for crop_area in classifier.crop_areas
+            ]
+            for example, (example_features, example_confidence, _) in enumerate(classifier.classify(crops)):
+                features[example] += example_features
+                confidence[example] = min(confidence[example], example_confidence)
+
+        for example, (key, _) in enumerate(batch):
+            yield key, { 'label': compose_label(features[example]), 'confidence': confidence[example] }
+
+# Execution section
+if __name__ == "__main__":
+
+    # HELP
+    # python2.7 prelabel.py input_path index_path --model blueprint:model_path [--model blueprint:model_path ...] [--batch-size N] [--workers N]
+    # python2.7 prelabel.py ../data/training-images ../data/training-set-index.json --model precipitation:../data/precipitation-model/saved-models/1549906046 --model wind:../data/wind-model/saved-models/1549906107 --model clouds:../data/clouds-model/saved-models/1549906188 --workers 8
+
+    parser = argparse.ArgumentParser(description='Suggests labels of the uncategorized meteorograms with trained models')
+    parser.add_argument('input_path', help='directory where meteorogram images are stored')
+    parser.add_argument('index_path', help='path to the feature index file, suggestions are stored next to it')
+    parser.add_argument('--model', action='append', required=True, help='blueprint name and exported model directory, e.g. wind:../data/wind-model/saved-models/1549906107')
+    parser.add_argument('--batch-size', type=int, default=512, help='number of meteorograms classified at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes cropping the meteorograms')
+    args = parser.parse_args()
+
+    models = [model.split(':', 1) for model in args.model]
+    for blueprint_name, _ in models:
+        if not blueprint_name in builder_blueprint.index:
+            raise ValueError('Unknown blueprint %s' % (blueprint_name))
+
+    crop_areas = []
+    for blueprint_name, _ in models:
+        for item in builder_blueprint.index[blueprint_name](''):
+            crop_area = get_crop_area_tuple(item['crop_area'])
+            if not crop_area in crop_areas:
+                crop_areas.append(crop_area)
+
+    keys = get_unlabeled_keys(args.index_path)
+    tasks = ((key, os.path.join(args.input_path, key + '.png'), crop_areas) for key in keys)
+    print('Suggesting labels of %d meteorograms' % (len(keys)))
+
+    # Worker processes are forked before any session is created
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    cropped_meteorograms = pool.imap(crop_task, tasks, chunksize=16) if pool else itertools.imap(crop_task, tasks)
+    classifiers = [BlueprintClassifier(blueprint_name, FrozenModelPredictor(model_path)) for blueprint_name, model_path in models]
+
+    suggestions = load_suggestions(args.index_path)
+    started_at = time.time()
+    processed = 0
+    try:
+        for key, suggestion in suggest_labels(cropped_meteorograms, classifiers, crop_areas, args.batch_size):
+            processed += 1
+            if suggestion is None:
+                print('Unable to decode meteorogram %s' % (key))
+                continue
+            suggestions[key] = suggestion
+
+            if processed % args.batch_size == 0:
+                sys.stdout.write('\rProcessed %d/%d meteorograms (%.1f images/s)' % (processed, len(keys), processed / (time.time() - started_at)))
+                sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        for classifier in classifiers:
+            classifier.close()
+
+    save_suggestions(args.index_path, suggestions)
+    elapsed = max(time.time() - started_at, 1e-6)
+    print('\nSuggested labels of %d meteorograms in %.1fs (%.1f images/s)' % (processed, elapsed, processed / elapsed))
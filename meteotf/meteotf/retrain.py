@@ -0,0 +1,166 @@
+import os
+import cv2
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import feature
+import builder_blueprint
+import tensorflow as tf
+
+from builder import MeteoTrainingSetBuilder, MeteoTrainingRecordWriter, get_item_label
+from trainer import MeteoMLModel, InputPipelineConfig, get_session_config
+from types import StringType
+
+def retrain_blueprint(task):
+    """
+    Builds the TFRecord files of a blueprint and trains its model, the function can be passed to a process pool.
+    Records are stored in <output_path>/<blueprint>-model/records, models in <output_path>/<blueprint>-model/saved-models.
+
+    Args:
+        task (dict): blueprint_name, input_path, index_path, output_path and the options of the build and the training.
+
+    Returns:
+        dict: summary of the training, error contains the traceback if the build or the training failed.
+    """
+    blueprint_name = task['blueprint_name']
+    assert type(blueprint_name) is StringType, 'blueprint_name: passed object of incorrect type'
+
+    started_at = time.time()
+    summary = { 'blueprint': blueprint_name, 'accuracy': None, 'exported_path': None, 'error': None }
+    records_path = os.path.join(task['output_path'], blueprint_name + '-model', 'records')
+    models_path = os.path.join(task['output_path'], blueprint_name + '-model', 'saved-models')
+
+    try:
+        cv2.setNumThreads(task['intra_op_threads'])
+        for path in [records_path, models_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        if not task['skip_build']:
+            builder = MeteoTrainingSetBuilder(task['input_path'], task['index_path'])
+            builder.build_streaming_tfrecord(
+                builder_blueprint.index[blueprint_name](''),
+                MeteoTrainingRecordWriter(records_path, 0.8, compression=task['compression'], record_format=task['format']),
+                record_format=task['format']
+            )
+
+        record_set = feature.load_record_set(records_path)
+        classes = record_set.get('split', {}).get('classes', {})
+        summary['training'] = sum(counts['training'] for counts in classes.values())
+        summary['validation'] = sum(counts['validation'] for counts in classes.values())
+
+        summary['n_classes'] = feature.get_n_classes(get_item_label(item) for item in builder_blueprint.index[blueprint_name](''))
+        meteo_model = MeteoMLModel(
+            models_path,
+            InputPipelineConfig(parallel_calls=task['intra_op_threads']),
+            n_classes=summary['n_classes'],
+            session_config=get_session_config(task['intra_op_threads'], task['inter_op_threads'])
+        )
+        summary['accuracy'] = meteo_model.train_with_early_stopping(
+            [os.path.join(records_path, filename) for filename in record_set['training']],
+            [os.path.join(records_path, filename) for filename in record_set['validation']],
+            max_steps=task['max_steps'],
+            eval_steps=task['eval_steps'],
+            patience=task['patience'],
+            compression=record_set['compression'],
+            record_format=record_set['format']
+        )
+
+        if summary['accuracy'] >= task['min_accuracy']:
+            summary['exported_path'] = meteo_model.save(models_path)
+    except Exception:
+        summary['error'] = traceback.format_exc()
+
+    summary['elapsed'] = time.time() - started_at
+    return summary
+
+def print_summary_table(summaries):
+    """ Prints a table of the trained models, blueprints which failed are followed by their tracebacks """
+    row_format = '%-14s %8s %9s %11s %9s %9s  %s'
+    print(row_format % ('blueprint', 'classes', 'training', 'validation', 'accuracy', 'time', 'exported model'))
+
+    for summary in summaries:
+        accuracy = '%.4f' % (summary['accuracy']) if summary['accuracy'] is not None else 'failed'
+        print(row_format % (
+            summary['blueprint'],
+            summary.get('n_classes', '-'),
+            summary.get('training', '-'),
+            summary.get('validation', '-'),
+            accuracy,
+            '%.0fs' % (summary['elapsed']),
+            summary['exported_path'] or '(not saved)'
+        ))
+
+    for summary in summaries:
+        if summary['error']:
+            print('\n%s failed:\n%s' % (summary['blueprint'], summary['error']))
+
+# Execution section
+if __name__ == "__main__":
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    # HELP
+    # python2.7 retrain.py input_path index_path output_path [blueprint ...] [--processes N] [--intra-op-threads N] [--inter-op-threads N]
+    # python2.7 retrain.py ../data/training-images ../data/training-set-index.json ../data
+    # python2.7 retrain.py ../data/training-images ../data/training-set-index.json ../data wind clouds --processes 2 --intra-op-threads 4
+
+    cpu_count = multiprocessing.cpu_count()
+
+    parser = argparse.ArgumentParser(description='Builds TFRecord files and trains models of several blueprints concurrently')
+    parser.add_argument('input_path', help='directory where meteorogram images are stored')
+    parser.add_argument('index_path', help='path to the feature index file')
+    parser.add_argument('output_path', help='directory where the records and models of every blueprint will be stored')
+    parser.add_argument('blueprints', nargs='*', help='blueprints to retrain, any of %s (default all)' % (', '.join(sorted(builder_blueprint.index.keys()))))
+    parser.add_argument('--processes', type=int, help='number of blueprints retrained at once (default all of them, at most the number of CPUs)')
+    parser.add_argument('--intra-op-threads', type=int, help='threads a single operation of a process uses (default CPUs divided by processes)')
+    parser.add_argument('--inter-op-threads', type=int, default=2, help='operations a process runs in parallel')
+    parser.add_argument('--compression', choices=['GZIP', 'ZLIB'], help='compression of the TFRecord shards')
+    parser.add_argument('--format', choices=feature.record_formats, default='raw', help='stored examples, JPEG encoded images or raw uint8 pixels')
+    parser.add_argument('--skip-build', action='store_true', help='train on the records built by the previous run')
+    parser.add_argument('--max-steps', type=int, default=8000, help='maximum number of training steps')
+    parser.add_argument('--eval-steps', type=int, default=500, help='number of training steps between evaluations of the model')
+    parser.add_argument('--patience', type=int, default=3, help='number of evaluations without improvement after which training stops')
+    parser.add_argument('--min-accuracy', type=float, default=0.8, help='minimal accuracy of a model which is exported')
+    args = parser.parse_args()
+
+    blueprints = args.blueprints or sorted(builder_blueprint.index.keys())
+    for blueprint_name in blueprints:
+        if not blueprint_name in builder_blueprint.index:
+            raise ValueError('Unknown blueprint %s' % (blueprint_name))
+
+    processes = args.processes or min(len(blueprints), cpu_count)
+    intra_op_threads = args.intra_op_threads or max(cpu_count // processes, 1)
+
+    tasks = [{
+        'blueprint_name': blueprint_name,
+        'input_path': args.input_path,
+        'index_path': args.index_path,
+        'output_path': args.output_path,
+        'skip_build': args.skip_build,
+        'compression': args.compression,
+        'format': args.format,
+        'max_steps': args.max_steps,
+        'eval_steps': args.eval_steps,
+        'patience': args.patience,
+        'min_accuracy': args.min_accuracy,
+        'intra_op_threads': intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+    } for blueprint_name in blueprints]
+
+    print('Retraining %s in %d processes, %d threads each' % (', '.join(blueprints), processes, intra_op_threads))
+    started_at = time.time()
+
+    # Every blueprint is retrained in a fresh process, no session is created in this one
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        summaries = pool.map(retrain_blueprint, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    print('\nRetrained %d blueprints in %.0fs\n' % (len(blueprints), time.time() - started_at))
+    print_summary_table(summaries)
+    sys.exit(1 if any(summary['error'] for summary in summaries) else 0)
@@ -0,0 +1,246 @@
+import cv2
+import json
+import time
+import Queue
+import argparse
+import threading
+import collections
+
+import numpy as np
+import feature
+import builder_blueprint
+import tensorflow as tf
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from builder import CroppedImage
+from editor import CropArea
+from inference import BlueprintClassifier, FrozenModelPredictor, compose_label
+from types import IntType, FloatType
+
+class MicroBatcher(object):
+    """
+    Class which coalesces predictions requested by concurrent threads into batches of a predictor.
+    A batch is run when it reaches max_batch_size examples or when its first request waited max_wait seconds.
+    It has the predict method of FrozenModelPredictor, so it can be passed to a BlueprintClassifier.
+    """
+
+    def __init__(self, predictor, max_batch_size=64, max_wait=0.005):
+        """
+        Args:
+            predictor (FrozenModelPredictor): predictor which runs the batches.
+            max_batch_size (int): maximum number of examples in a batch.
+            max_wait (float): maximum time a request waits for other requests (in seconds).
+        """
+
+        assert type(max_batch_size) is IntType and max_batch_size > 0, 'max_batch_size: passed object of incorrect type'
+        assert type(max_wait) is FloatType, 'max_wait: passed object of incorrect type'
+
+        self._predictor = predictor
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._requests = Queue.Queue()
+        self._batch_sizes = collections.deque(maxlen=10000)
+
+        worker = threading.Thread(target=self._run_batches)
+        worker.daemon = True
+        worker.start()
+
+    def predict(self, pixels):
+        """
+        Returns:
+            ndarray: class probabilities of the examples, computed together with examples of other requests.
+        """
+        request = { 'pixels': np.asarray(pixels).reshape([-1] + feature.input_shape), 'done': threading.Event() }
+        self._requests.put(request)
+        request['done'].wait()
+
+        if 'error' in request:
+            raise request['error']
+        return request['probabilities']
+
+    @property
+    def mean_batch_size(self):
+        batch_sizes = list(self._batch_sizes)
+        return float(np.mean(batch_sizes)) if batch_sizes else 0.0
+
+    def close(self):
+        self._predictor.close()
+
+    def _run_batches(self):
+        while True:
+            requests = [self._requests.get()]
+            examples_count = len(requests[0]['pixels'])
+            deadline = time.time() + self._max_wait
+
+            while examples_count < self._max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                requests.append(request)
+                examples_count += len(request['pixels'])
+
+            try:
+                probabilities = self._predictor.predict(np.concatenate([request['pixels'] for request in requests]))
+                offset = 0
+                for request in requests:
+                    request['probabilities'] = probabilities[offset:offset + len(request['pixels'])]
+                    offset += len(request['pixels'])
+            except Exception as error:
+                for request in requests:
+                    request['error'] = error
+
+            self._batch_sizes.append(examples_count)
+            for request in requests:
+                request['done'].set()
+
+class LatencyStats(object):
+    """ Class which collects latencies of the recent requests """
+
+    def __init__(self, window=10000):
+        """
+        Args:
+            window (int): number of the most recent requests the percentiles are computed over.
+        """
+        self._latencies = collections.deque(maxlen=window)
+        self._requests_count = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._requests_count += 1
+
+    def summary(self):
+        """
+        Returns:
+            dict: number of requests and latency percentiles of the recent ones (in milliseconds).
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            requests_count = self._requests_count
+
+        summary = { 'requests': requests_count }
+        if len(latencies) > 0:
+            summary['latency_ms'] = dict(
+                [('p%d' % (percentile), float(np.percentile(latencies, percentile))) for percentile in [50, 90, 95, 99]],
+                mean=float(np.mean(latencies)),
+                max=float(np.max(latencies))
+            )
+        return summary
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server which handles every request in its own thread, predictions of the threads are batched together """
+
+    daemon_threads = True
+
+    def __init__(self, address, blueprint_name, batcher):
+        HTTPServer.__init__(self, address, PredictionRequestHandler)
+        self.batcher = batcher
+        self.classifier = BlueprintClassifier(blueprint_name, batcher)
+        self.stats = LatencyStats()
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict with a PNG image in the body, either a full meteorogram or a crop of input_width x input_height pixels.
+    GET /stats returns the number of served predictions, latency percentiles and the mean batch size.
+    """
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._send_json(404, { 'error': 'Unknown path %s' % (self.path) })
+
+        started_at = time.time()
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return self._send_json(400, { 'error': 'Unable to decode the image' })
+
+        is_crop = image.shape[:2] == (feature.input_height, feature.input_width)
+        if not is_crop and not self._contains_crop_areas(image):
+            return self._send_json(400, { 'error': 'Image of %dx%d pixels is neither a meteorogram nor a crop of %dx%d pixels' % (
+                image.shape[1], image.shape[0], feature.input_width, feature.input_height
+            )})
+
+        try:
+            response = self._predict_crop(image) if is_crop else self._predict_meteorogram(image)
+        except Exception as error:
+            return self._send_json(500, { 'error': 'Prediction failed: %s' % (error) })
+
+        self.server.stats.record(time.time() - started_at)
+        self._send_json(200, response)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._send_json(404, { 'error': 'Unknown path %s' % (self.path) })
+
+        stats = self.server.stats.summary()
+        stats['mean_batch_size'] = self.server.batcher.mean_batch_size
+        self._send_json(200, stats)
+
+    def log_message(self, format, *args):
+        pass # every request would be logged, /stats summarizes them instead
+
+    def _contains_crop_areas(self, image):
+        height, width = image.shape[:2]
+        return all(x + area_width <= width and y + area_height <= height for x, y, area_width, area_height in self.server.classifier.crop_areas)
+
+    def _predict_crop(self, image):
+        classifier = self.server.classifier
+        pixels = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        class_name, confidence, probabilities = classifier.classify_crops([pixels])[0]
+        return {
+            'predicted': class_name,
+            'confidence': confidence,
+            'probabilities': dict(zip(classifier.class_names, probabilities)),
+        }
+
+    def _predict_meteorogram(self, image):
+        classifier = self.server.classifier
+        crops = [[CroppedImage(image, CropArea(*crop_area)).pixels] for crop_area in classifier.crop_areas]
+        features, confidence, probabilities = classifier.classify(crops)[0]
+        return {
+            'label': compose_label(features),
+            'confidence': confidence,
+            'probabilities': dict(zip(classifier.class_names, probabilities)),
+        }
+
+    def _send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Execution section
+if __name__ == "__main__":
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    # HELP
+    # python2.7 server.py blueprint model_path [--host HOST] [--port N] [--max-batch-size N] [--max-wait-ms N]
+    # python2.7 server.py wind ../data/wind-model/saved-models/1549906107 --port 8080
+    # curl --data-binary @../data/training-images/2019010100-336-200.png http://localhost:8080/predict
+    # curl http://localhost:8080/stats
+
+    parser = argparse.ArgumentParser(description='Serves predictions of a frozen model over HTTP')
+    parser.add_argument('blueprint_name', choices=sorted(builder_blueprint.index.keys()), help='blueprint the model was trained on')
+    parser.add_argument('model_path', help='exported model directory which contains the frozen graph')
+    parser.add_argument('--host', default='localhost', help='address the server listens on')
+    parser.add_argument('--port', type=int, default=8080, help='port the server listens on')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='maximum number of examples predicted at once')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='maximum time a request waits for other requests')
+    args = parser.parse_args()
+
+    batcher = MicroBatcher(FrozenModelPredictor(args.model_path), args.max_batch_size, args.max_wait_ms / 1000.0)
+    server = PredictionServer((args.host, args.port), args.blueprint_name, batcher)
+    print('Serving predictions of %s on http://%s:%d/predict' % (args.model_path, args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import itertools
+import traceback
+import multiprocessing
+
+import feature
+import tensorflow as tf
+
+from manifest import file_checksum, write_atomically
+from trainer import MeteoMLModel, InputPipelineConfig, get_session_config
+from types import DictType
+
+""" Values of the hyperparameters a trial doesn't set """
+default_trial = { 'hidden_units': [], 'batch_size': 30, 'shuffle_buffer': 5000, 'steps': 8000, 'eval_steps': 500, 'patience': 3 }
+
+def expand_grid(sweep_config):
+    """
+    Args:
+        sweep_config (dict): lists of values of every swept hyperparameter under 'grid', other keys are shared by all trials,
+            e.g. { "grid": { "hidden_units": [[], [64]], "batch_size": [30, 128] }, "steps": 4000 }.
+
+    Returns:
+        list: hyperparameters of every trial, all combinations of the grid values.
+    """
+    assert type(sweep_config) is DictType, 'sweep_config: passed object of incorrect type'
+
+    grid = sweep_config.get('grid', {})
+    shared = dict((name, value) for name, value in sweep_config.items() if name != 'grid')
+    for name in list(grid.keys()) + list(shared.keys()):
+        if not name in default_trial:
+            raise ValueError('Unknown hyperparameter %s' % (name))
+
+    names = sorted(grid.keys())
+    trials = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        trial = dict(default_trial)
+        trial.update(shared)
+        trial.update(zip(names, values))
+        trials.append(trial)
+    return trials
+
+def get_trial_id(trial):
+    """
+    Returns:
+        str: Hash of the trial hyperparameters.
+    """
+    return hashlib.md5(json.dumps(trial, sort_keys=True)).hexdigest()[:12]
+
+def get_result_key(trial, dataset_fingerprint):
+    """
+    Returns:
+        str: Key of the trial result, results are memoized by the trial hyperparameters and the dataset.
+    """
+    return '%s-%s' % (get_trial_id(trial), dataset_fingerprint)
+
+def get_dataset_fingerprint(records_dir):
+    """
+    Returns:
+        str: Hash of the record set description and the contents of all its record files.
+    """
+    record_set = feature.load_record_set(records_dir)
+    fingerprint = hashlib.md5(json.dumps(record_set, sort_keys=True))
+    for filename in record_set['training'] + record_set['validation']:
+        fingerprint.update(file_checksum(os.path.join(records_dir, filename)))
+    return fingerprint.hexdigest()[:12]
+
+def load_results(results_path):
+    if not os.path.exists(results_path):
+        return {}
+    with open(results_path) as infile:
+        return json.load(infile)
+
+def save_results(results_path, results):
+    write_atomically(results_path, json.dumps(results, indent=4, sort_keys=True))
+
+def fill_cache(task):
+    """
+    Parses the examples of both sets once into the cache files, so trials only read them and none of them writes a cache concurrently.
+    """
+    record_set = feature.load_record_set(task['records_dir'])
+    model_dir = tempfile.mkdtemp()
+    try:
+        model = MeteoMLModel(model_dir, InputPipelineConfig(cache=task['cache']))
+        for set_name in ['training', 'validation']:
+            record_files = [os.path.join(task['records_dir'], filename) for filename in record_set[set_name]]
+            next_batch = model._prepare_dataset(record_files, 1, record_set['compression'], record_set['format']).make_one_shot_iterator().get_next()
+            with tf.Session() as session:
+                while True:
+                    try:
+                        session.run(next_batch)
+                    except tf.errors.OutOfRangeError:
+                        break
+    finally:
+        shutil.rmtree(model_dir)
+
+def run_trial(task):
+    """
+    Trains a model with the hyperparameters of a trial, the function can be passed to a process pool.
+
+    Args:
+        task (dict): trial hyperparameters, records_dir, model_dir, cache and the thread caps of the process.
+
+    Returns:
+        dict: the task with the validation accuracy, number of trained steps and training time, or the traceback of an error.
+    """
+    trial = task['trial']
+    record_set = feature.load_record_set(task['records_dir'])
+    result = { 'trial': trial, 'model_dir': task['model_dir'], 'accuracy': None, 'error': None }
+    started_at = time.time()
+
+    try:
+        # A trial interrupted by the previous run starts from scratch
+        if os.path.exists(task['model_dir']):
+            shutil.rmtree(task['model_dir'])
+
+        meteo_model = MeteoMLModel(
+            task['model_dir'],
+            InputPipelineConfig(
+                batch_size=trial['batch_size'],
+                shuffle_buffer=trial['shuffle_buffer'],
+                parallel_calls=task['intra_op_threads'],
+                cache=task['cache']
+            ),
+            n_classes=task['n_classes'],
+            session_config=get_session_config(task['intra_op_threads'], task['inter_op_threads']),
+            hidden_units=trial['hidden_units']
+        )
+        result['accuracy'] = float(meteo_model.train_with_early_stopping(
+            [os.path.join(task['records_dir'], filename) for filename in record_set['training']],
+            [os.path.join(task['records_dir'], filename) for filename in record_set['validation']],
+            max_steps=trial['steps'],
+            eval_steps=trial['eval_steps'],
+            patience=trial['patience'],
+            compression=record_set['compression'],
+            record_format=record_set['format']
+        ))
+        result['trained_steps'] = meteo_model.trained_steps
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    result['elapsed'] = time.time() - started_at
+    return result
+
+def print_results_table(results):
+    """ Prints the trials ordered by their accuracy, the best one first """
+    row_format = '%9s %8s %-16s %6s %8s %8s  %s'
+    print(row_format % ('accuracy', 'steps', 'hidden_units', 'batch', 'max', 'time', 'model'))
+
+    for result in sorted(results, key=lambda result: result['accuracy'], reverse=True):
+        trial = result['trial']
+        print(row_format % (
+            '%.4f' % (result['accuracy']),
+            result['trained_steps'],
+            json.dumps(trial['hidden_units']),
+            trial['batch_size'],
+            trial['steps'],
+            '%.0fs' % (result['elapsed']),
+            result['model_dir']
+        ))
+
+# Execution section
+if __name__ == "__main__":
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    # HELP
+    # python2.7 sweep.py records_path sweep_config output_path [--processes N] [--intra-op-threads N] [--inter-op-threads N]
+    # python2.7 sweep.py ../data/wind-model/records ../data/wind-sweep.json ../data/wind-model/sweep --processes 4
+    #
+    # wind-sweep.json:
+    # { "grid": { "hidden_units": [[], [64], [128, 32]], "batch_size": [30, 128], "steps": [4000, 8000] }, "eval_steps": 250 }
+
+    cpu_count = multiprocessing.cpu_count()
+
+    parser = argparse.ArgumentParser(description='Trains models with every combination of hyperparameters of a grid')
+    parser.add_argument('records_path', help='directory where TFRecord files are located')
+    parser.add_argument('sweep_config', help='JSON file with the grid of hyperparameters')
+    parser.add_argument('output_path', help='directory where the trial models, results and cached examples will be stored')
+    parser.add_argument('--processes', type=int, help='number of trials trained at once (default the number of CPUs, at most the number of trials)')
+    parser.add_argument('--intra-op-threads', type=int, help='threads a single operation of a process uses (default CPUs divided by processes)')
+    parser.add_argument('--inter-op-threads', type=int, default=2, help='operations a process runs in parallel')
+    parser.add_argument('--n-classes', type=int, help='number of classes of the model (default taken from the records)')
+    args = parser.parse_args()
+
+    with open(args.sweep_config) as infile:
+        trials = expand_grid(json.load(infile))
+
+    dataset_fingerprint = get_dataset_fingerprint(args.records_path)
+    results_path = os.path.join(args.output_path, 'results.json')
+    results = load_results(results_path)
+    cache = os.path.join(args.output_path, 'cache', dataset_fingerprint)
+
+    for path in [os.path.dirname(cache), os.path.join(args.output_path, 'trials')]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    # Results are memoized, rerunning a sweep trains only trials without a result
+    pending_trials = [trial for trial in trials if not get_result_key(trial, dataset_fingerprint) in results]
+    processes = max(min(args.processes or cpu_count, len(pending_trials)), 1)
+    intra_op_threads = args.intra_op_threads or max(cpu_count // processes, 1)
+    n_classes = args.n_classes or feature.get_record_set_n_classes(feature.load_record_set(args.records_path))
+
+    tasks = [{
+        'trial': trial,
+        'records_dir': args.records_path,
+        'model_dir': os.path.join(args.output_path, 'trials', get_result_key(trial, dataset_fingerprint)),
+        'cache': cache,
+        'n_classes': n_classes,
+        'intra_op_threads': intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+    } for trial in pending_trials]
+
+    print('%d trials, %d finished by previous runs, training %d in %d processes' % (len(trials), len(trials) - len(tasks), len(tasks), processes))
+
+    # Every trial is trained in a fresh process, no session is created in this one
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    failed = 0
+    try:
+        if len(tasks) > 0:
+            pool.apply(fill_cache, [{ 'records_dir': args.records_path, 'cache': cache }])
+
+        for finished, result in enumerate(pool.imap_unordered(run_trial, tasks), 1):
+            trial_id = get_trial_id(result['trial'])
+            if result['error']:
+                failed += 1
+                print('Trial %s failed:\n%s' % (trial_id, result['error']))
+                continue
+
+            results[get_result_key(result['trial'], dataset_fingerprint)] = result
+            save_results(results_path, results)
+            print('Trial %s finished (%d/%d), accuracy: %.4f' % (trial_id, finished, len(tasks), result['accuracy']))
+    finally:
+        pool.close()
+        pool.join()
+
+    print('')
+    print_results_table([
+        results[get_result_key(trial, dataset_fingerprint)] for trial in trials
+        if get_result_key(trial, dataset_fingerprint) in results
+    ])
+    sys.exit(1 if failed else 0)
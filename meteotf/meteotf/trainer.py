@@ -1,44 +1,231 @@
 import os
 import sys
+import json
+import hashlib
+import argparse
 import feature
 import tfcoreml
 import tensorflow as tf
 import tensorflow.train as tft
 import tensorflow.compat as tfc
 
-class MeteoMLModel(object):
+from builder import get_record_options
+
+class InputPipelineConfig(object):
+    """ Class which encapsulates tunables of the training input pipeline. """
+
+    def __init__(self, batch_size=30, shuffle_buffer=5000, parallel_calls=4, cycle_length=8, prefetch=2, cache=None):
+        """
+        Args:
+            batch_size (int): number of examples in a batch.
+            shuffle_buffer (int): number of examples the shuffling is done over.
+            parallel_calls (int): number of batches parsed in parallel.
+            cycle_length (int): number of record files read in parallel.
+            prefetch (int): number of batches prepared ahead of the training step.
+            cache (str): None disables caching of parsed examples, empty string caches them in memory,
+                otherwise path prefix of local cache files, one file per set of record files.
+        """
+        assert type(batch_size) is int and batch_size > 0, 'batch_size: passed object of incorrect type'
+        assert type(shuffle_buffer) is int, 'shuffle_buffer: passed object of incorrect type'
+        assert type(parallel_calls) is int and parallel_calls > 0, 'parallel_calls: passed object of incorrect type'
+        assert type(cycle_length) is int and cycle_length > 0, 'cycle_length: passed object of incorrect type'
+        assert type(prefetch) is int, 'prefetch: passed object of incorrect type'
+
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.parallel_calls = parallel_calls
+        self.cycle_length = cycle_length
+        self.prefetch = prefetch
+        self.cache = cache
+
+class TrainedExamples(object):
+    """
+    Class which keeps fingerprints of the examples a model was already trained on, in a file next to its checkpoints.
+    Builder serializes examples deterministically, so an example keeps its fingerprint when the records are rebuilt.
+    """
 
     def __init__(self, output_path):
-        self._model = tf.estimator.DNNClassifier(
-            hidden_units=[],
-            n_classes=3,
-            feature_columns=feature.feature_columns,
-            model_dir=output_path
-        )
+        """
+        Args:
+            output_path (str): directory where the model data is stored.
+        """
+        self.path = os.path.join(output_path, 'trained-examples.json')
+        self._fingerprints = set()
+        self._new_fingerprints = set()
+
+        if os.path.exists(self.path):
+            with open(self.path) as infile:
+                self._fingerprints = set(json.load(infile))
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def write_new_examples(self, record_files, destination_path=None, compression=''):
+        """
+        Method copies examples which aren't among the trained ones into a single record file,
+        they are only collected if destination_path is None. The collected examples are marked as trained by save.
+
+        Returns:
+            int: Number of new examples.
+        """
+        options = get_record_options(compression)
+        writer = tf.python_io.TFRecordWriter(destination_path, options) if destination_path else None
+        self._new_fingerprints = set()
+
+        for record_file in record_files:
+            for record in tf.python_io.tf_record_iterator(record_file, options):
+                fingerprint = hashlib.md5(record).hexdigest()
+                if not fingerprint in self._fingerprints and not fingerprint in self._new_fingerprints:
+                    self._new_fingerprints.add(fingerprint)
+                    if writer:
+                        writer.write(record)
+
+        if writer:
+            writer.close()
+        return len(self._new_fingerprints)
+
+    def save(self):
+        """ Method marks the new examples as trained """
+        self._fingerprints |= self._new_fingerprints
+        self._new_fingerprints = set()
+        with open(self.path, 'w') as outfile:
+            json.dump(sorted(self._fingerprints), outfile)
+
+class EarlyStoppingListener(tft.CheckpointSaverListener):
+    """
+    Class which evaluates every checkpoint saved during the training and keeps the best of them,
+    training is stopped when the accuracy didn't improve by min_delta for patience checkpoints.
+    """
+
+    def __init__(self, model_dir, evaluate, patience=3, min_delta=0.001):
+        """
+        Args:
+            model_dir (str): directory where the checkpoints are saved.
+            evaluate (function): function which returns the validation accuracy of the latest checkpoint.
+        """
+        self._model_dir = model_dir
+        self._evaluate = evaluate
+        self._patience = patience
+        self._min_delta = min_delta
+        self._checkpoints_without_improvement = 0
+        self.best_accuracy = None
+        self.best_checkpoint = None
+
+    def after_save(self, session, global_step_value):
+        accuracy = self._evaluate()
+        if self.best_accuracy is None or accuracy > self.best_accuracy + self._min_delta:
+            self.best_accuracy = accuracy
+            self.best_checkpoint = tf.train.latest_checkpoint(self._model_dir)
+            self._checkpoints_without_improvement = 0
+            return False
+
+        self._checkpoints_without_improvement += 1
+        if self._checkpoints_without_improvement >= self._patience:
+            print('Early stopping after %d steps, best accuracy: %f' % (global_step_value, self.best_accuracy))
+            return True
+        return False
+
+class MeteoMLModel(object):
+
+    def __init__(self, output_path, pipeline_config=None, warm_start_from=None, n_classes=3, session_config=None, hidden_units=None):
+        """
+        Args:
+            output_path (str): directory where checkpoints are stored, training is resumed from the latest of them.
+            pipeline_config (InputPipelineConfig): tunables of the input pipeline.
+            warm_start_from (str): checkpoint directory or exported model used to initialize a model which has no checkpoints yet,
+                by default the latest model exported into output_path.
+            n_classes (int): number of classes the model predicts, at least 2.
+            session_config (ConfigProto): configuration of the training sessions, e.g. thread pool sizes.
+            hidden_units (list): sizes of the hidden layers, a linear model by default.
+        """
+        assert type(n_classes) is int and n_classes > 1, 'n_classes: passed object of incorrect type'
+
+        self._pipeline_config = pipeline_config or InputPipelineConfig()
+
+        warm_start = None
+        if tf.train.latest_checkpoint(output_path) is None:
+            warm_start_path = get_checkpoint_path(warm_start_from or get_latest_export(output_path))
+            if warm_start_path:
+                print('Warm start from %s' % (warm_start_path))
+                warm_start = tf.estimator.WarmStartSettings(ckpt_to_initialize_from=warm_start_path)
+
+        self._estimator_params = {
+            'hidden_units': hidden_units or [],
+            'n_classes': n_classes,
+            'feature_columns': feature.feature_columns,
+            'model_dir': output_path,
+            'warm_start_from': warm_start,
+        }
+        self._model = tf.estimator.DNNClassifier(config=tf.estimator.RunConfig(session_config=session_config), **self._estimator_params)
     
-    def train(self, training_set, epochs=20, steps=8000):        
-        training_dataset = self._prepare_dataset(training_set, epochs)
+    def train(self, training_set, epochs=20, steps=8000, compression='', record_format='jpeg'):        
+        training_dataset = self._prepare_dataset(training_set, epochs, compression, record_format)
         self._model.train(lambda:self._input_function(training_dataset), steps=steps)
 
-    def evaluate(self, validation_set):
-        validation_dataset = self._prepare_dataset(validation_set, 1)
-        test_accuracy = self._model.evaluate(lambda:self._input_function(validation_dataset))['accuracy']
+    def train_with_early_stopping(self, training_set, validation_set, max_steps=8000, eval_steps=500, patience=3, min_delta=0.001, epochs=20, compression='', record_format='jpeg'):
+        """
+        Method trains the model on a single input pipeline, a checkpoint is saved and evaluated every eval_steps.
+        Training stops when the validation accuracy didn't improve by min_delta for patience checkpoints, or after max_steps.
+        The best checkpoint becomes the latest one, so the model is exported and resumed from it.
+
+        Returns:
+            float: Validation accuracy of the best checkpoint.
+        """
+        model_dir = self._estimator_params['model_dir']
+        config = self._model.config.replace(
+            save_checkpoints_steps=eval_steps,
+            save_checkpoints_secs=None,
+            keep_checkpoint_max=max(patience + 2, self._model.config.keep_checkpoint_max)
+        )
+        model = tf.estimator.DNNClassifier(config=config, **self._estimator_params)
+        listener = EarlyStoppingListener(model_dir, lambda:self.evaluate(validation_set, compression, record_format), patience, min_delta)
+
+        training_dataset = self._prepare_dataset(training_set, epochs, compression, record_format)
+        model.train(lambda:self._input_function(training_dataset), steps=max_steps, saving_listeners=[listener])
+
+        checkpoint_state = tf.train.get_checkpoint_state(model_dir)
+        if listener.best_checkpoint != checkpoint_state.model_checkpoint_path:
+            print('Restored the best checkpoint %s' % (listener.best_checkpoint))
+            checkpoints = [checkpoint for checkpoint in checkpoint_state.all_model_checkpoint_paths if checkpoint != listener.best_checkpoint]
+            tf.train.update_checkpoint_state(model_dir, listener.best_checkpoint, checkpoints + [listener.best_checkpoint])
+        return listener.best_accuracy
+
+    @property
+    def trained_steps(self):
+        """
+        Returns:
+            int: Global step of the latest checkpoint, 0 for a model which has no checkpoint yet.
+        """
+        if tf.train.latest_checkpoint(self._model.model_dir) is None:
+            return 0
+        return int(self._model.get_variable_value(tf.GraphKeys.GLOBAL_STEP))
+
+    def evaluate(self, validation_set, compression='', record_format='jpeg'):
+        # Dataset is built in the graph of the evaluation, so the model can be evaluated while it's trained
+        test_accuracy = self._model.evaluate(
+            lambda:self._input_function(self._prepare_dataset(validation_set, 1, compression, record_format))
+        )['accuracy']
 
         print('Test accuracy:', test_accuracy)
         return test_accuracy
 
-    def predict(self, prediction_set, expected_class):
-        prediction_dataset = self._prepare_dataset(prediction_set, 1)
+    def predict(self, prediction_set, expected_class, compression='', record_format='jpeg'):
+        prediction_dataset = self._prepare_dataset(prediction_set, 1, compression, record_format)
         predictions = self._model.predict(lambda:self._input_function(prediction_dataset))
         self._print_prediction_summary(predictions, expected_class)       
 
-    def save(self, export_dir):       
+    def save(self, export_dir):
+        """
+        Returns:
+            str: Path of the exported model directory.
+        """
         input_fn = tf.estimator.export.build_parsing_serving_input_receiver_fn({
             'image/encoded': tf.FixedLenFeature([90 * 42], tf.string)
         })
 
         exported_path =  self._model.export_savedmodel(export_dir, input_fn, as_text=False)        
         self._save_frozen_graph(exported_path, os.path.join(exported_path, 'frozen_model.pb'))
+        return exported_path
 
     def _save_frozen_graph(self, export_dir, output_path):
         with tf.Session(graph=tf.Graph()) as session:
@@ -54,12 +241,37 @@ class MeteoMLModel(object):
                 sys.stdout.flush() 
                 print('Exported: Frozen graph')                    
 
-    def _prepare_dataset(self, record_files, num_epochs):
-        dataset = tf.data.TFRecordDataset(record_files)
-        dataset = dataset.map(feature.parse_record)
-        dataset = dataset.shuffle(buffer_size=5000, reshuffle_each_iteration=True)
-        dataset = dataset.batch(30)
-        dataset = dataset.repeat(num_epochs)
+    def _prepare_dataset(self, record_files, num_epochs, compression='', record_format='jpeg'):
+        if len(record_files) == 0:
+            raise ValueError('No record files to read, the record set is empty')
+
+        config = self._pipeline_config
+        parse_batch = lambda records: feature.parse_record_batch(records, record_format)
+
+        # Shards are read in parallel, records of consecutive shards are interleaved
+        dataset = tf.data.Dataset.from_tensor_slices(record_files)
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            lambda record_file: tf.data.TFRecordDataset(record_file, compression_type=compression),
+            cycle_length=min(len(record_files), config.cycle_length)
+        ))
+
+        if config.cache is not None:
+            # Examples are parsed once and then served from the cache in every epoch
+            dataset = dataset.batch(config.batch_size)
+            dataset = dataset.map(parse_batch, num_parallel_calls=config.parallel_calls)
+            dataset = dataset.apply(tf.contrib.data.unbatch())
+            dataset = dataset.cache(get_cache_path(config.cache, record_files))
+            dataset = dataset.shuffle(buffer_size=config.shuffle_buffer, reshuffle_each_iteration=True)
+            dataset = dataset.repeat(num_epochs)
+            dataset = dataset.batch(config.batch_size)
+        else:
+            # Serialized examples are shuffled and parsed a whole batch at once
+            dataset = dataset.shuffle(buffer_size=config.shuffle_buffer, reshuffle_each_iteration=True)
+            dataset = dataset.repeat(num_epochs)
+            dataset = dataset.batch(config.batch_size)
+            dataset = dataset.map(parse_batch, num_parallel_calls=config.parallel_calls)
+
+        dataset = dataset.prefetch(config.prefetch)
         
         print('Initialized: Dataset')
         return dataset
@@ -84,26 +296,129 @@ class MeteoMLModel(object):
             class_id=class_id,
         ))
 
+# Helper functions
+def get_session_config(intra_op_threads, inter_op_threads):
+    """
+    Returns:
+        ConfigProto: session configuration which caps the number of threads a training process uses.
+    """
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)
+
+def get_cache_path(cache, record_files):
+    """
+    Path of the cache file depends on the names, sizes and modification times of the record files,
+    so records rebuilt under the same names are parsed again instead of being served from a stale cache.
+
+    Returns:
+        str: Path of the cache file of parsed examples of the record files, empty string for the in-memory cache.
+    """
+    if not cache:
+        return cache
+
+    fingerprint = hashlib.md5()
+    for record_file in record_files:
+        stat = os.stat(record_file)
+        fingerprint.update('%s:%d:%r\n' % (os.path.abspath(record_file), stat.st_size, stat.st_mtime))
+    return '%s-%s' % (cache, fingerprint.hexdigest()[:12])
+
+def get_latest_export(output_path):
+    """
+    Returns:
+        str: Path of the latest model exported into output_path, None if there's none.
+    """
+    if not os.path.exists(output_path):
+        return None
+
+    exports = [
+        filename for filename in os.listdir(output_path)
+        if filename.isdigit() and os.path.exists(os.path.join(output_path, filename, 'saved_model.pb'))
+    ]
+    return os.path.join(output_path, max(exports, key=int)) if exports else None
+
+def get_checkpoint_path(model_path):
+    """
+    Returns:
+        str: Checkpoint of an exported model or the latest checkpoint in a directory, None if there's none.
+    """
+    if model_path is None:
+        return None
+    if os.path.exists(os.path.join(model_path, 'saved_model.pb')):
+        return os.path.join(model_path, tf.saved_model.constants.VARIABLES_DIRECTORY, tf.saved_model.constants.VARIABLES_FILENAME)
+    return tf.train.latest_checkpoint(model_path)
+
 # Execution section
 if __name__ == "__main__":     
     tf.logging.set_verbosity(tf.logging.DEBUG)
 
     # HELP
-    # python2.7 trainer.py input_path output_path
+    # python2.7 trainer.py input_path output_path [--batch-size N] [--shuffle-buffer N] [--parallel-calls N] [--prefetch N] [--cache [PATH]]
+    #                       [--max-steps N] [--eval-steps N] [--patience N] [--warm-start PATH] [--incremental] [--n-classes N]
     # python2.7 trainer.py ../data/wind-model/records/ ../data/wind-model/saved-models
+    # python2.7 trainer.py ../data/wind-model/records/ ../data/wind-model/saved-models --parallel-calls 8 --cache
+    # python2.7 trainer.py ../data/wind-model/records/ ../data/wind-model/saved-models --incremental
+
+    parser = argparse.ArgumentParser(description='Trains a meteorogram classifier on TFRecord files built by the builder')
+    parser.add_argument('input_path', help='directory where TFRecord files are located')
+    parser.add_argument('output_path', help='directory where the model data will be stored')
+    parser.add_argument('--batch-size', type=int, default=30, help='number of examples in a batch')
+    parser.add_argument('--shuffle-buffer', type=int, default=5000, help='number of examples the shuffling is done over')
+    parser.add_argument('--parallel-calls', type=int, default=4, help='number of batches parsed in parallel')
+    parser.add_argument('--cycle-length', type=int, default=8, help='number of record files read in parallel')
+    parser.add_argument('--prefetch', type=int, default=2, help='number of batches prepared ahead of the training step')
+    parser.add_argument('--cache', nargs='?', const='', help='cache parsed examples in memory, or in a local file if a path is passed')
+    parser.add_argument('--max-steps', type=int, default=8000, help='maximum number of training steps')
+    parser.add_argument('--eval-steps', type=int, default=500, help='number of training steps between evaluations of the model')
+    parser.add_argument('--patience', type=int, default=3, help='number of evaluations without improvement after which training stops')
+    parser.add_argument('--warm-start', help='checkpoint directory or exported model used to initialize a new model, by default the latest model exported into output_path')
+    parser.add_argument('--incremental', action='store_true', help='train only examples the model in output_path was not trained on yet')
+    parser.add_argument('--n-classes', type=int, help='number of classes of the model (default taken from the records)')
+    args = parser.parse_args()
 
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
+    input_path = args.input_path
+    output_path = args.output_path
+    pipeline_config = InputPipelineConfig(
+        batch_size=args.batch_size,
+        shuffle_buffer=args.shuffle_buffer,
+        parallel_calls=args.parallel_calls,
+        cycle_length=args.cycle_length,
+        prefetch=args.prefetch,
+        cache=args.cache
+    )
     
-    training_records = [os.path.join(input_path, 'training.TFRecord')]
-    evaluation_records = [os.path.join(input_path, 'validation.TFRecord')]
+    record_set = feature.load_record_set(input_path)
+    training_records = [os.path.join(input_path, filename) for filename in record_set['training']]
+    evaluation_records = [os.path.join(input_path, filename) for filename in record_set['validation']]
+    compression = record_set['compression']
+    record_format = record_set['format']
             
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    meteo_model = MeteoMLModel(output_path)   
-    meteo_model.train(training_records)            
-    test_accuracy =  meteo_model.evaluate(evaluation_records)
+    trained_examples = TrainedExamples(output_path)
+    if args.incremental:
+        new_examples_path = os.path.join(output_path, 'new-examples.tfrecord')
+        new_examples = trained_examples.write_new_examples(training_records, new_examples_path, compression)
+        print('%d new examples, %d examples already trained' % (new_examples, len(trained_examples)))
+        if new_examples == 0:
+            exit(0)
+        training_records = [new_examples_path]
+    else:
+        trained_examples.write_new_examples(training_records, compression=compression)
+
+    n_classes = args.n_classes or feature.get_record_set_n_classes(record_set)
+    meteo_model = MeteoMLModel(output_path, pipeline_config, args.warm_start, n_classes)
+    initial_steps = meteo_model.trained_steps
+    test_accuracy = meteo_model.train_with_early_stopping(
+        training_records, evaluation_records,
+        max_steps=args.max_steps, eval_steps=args.eval_steps, patience=args.patience,
+        compression=compression, record_format=record_format
+    )
+
+    # Early stopping may restore a checkpoint which precedes the training of the new examples
+    if meteo_model.trained_steps > initial_steps:
+        trained_examples.save()
+    else:
+        print('Best checkpoint precedes this training, examples are NOT marked as trained')
 
     if test_accuracy < 0.8:
         print('Model NOT saved, test accuracy too low')
@@ -1,25 +1,42 @@
 import os
-import sys
+import csv
+import zlib
+import json
+import time
+import Queue
+import socket
+import httplib
+import tempfile
 import urllib2
+import hashlib
+import urlparse
+import argparse
 import datetime
+import threading
+import collections
+
+from meteotf.manifest import DirectoryManifest, write_atomically
 
 # http://www.meteo.pl/um/metco/mgram_pict.php?ntype=0u&fdate=2018051812&row=383&col=209&lang=pl
 
 # HELP
-# python2.7 setup.py destination_dir
-# python2.7 setup.py ../data/prediction-images
-
-""" Directory when we will store all the downloaded meteorograms """
-destination_dir = sys.argv[1]
-
-""" We skip files which are already present in this directory """
-# filter_dir = 'data/source-images/'
-filter_dir = destination_dir
+# python2.7 setup.py destination_dir [--locations PATH] [--shard I/N] [--workers N] [--rate-limit SECONDS] [--retries N] [--full] [--max-misses N] [--verify] [--base-url URL]
+# python2.7 setup.py ../data/prediction-images --locations ../data/locations.csv --shard 0/4
+# python2.7 setup.py ../data/prediction-images --workers 8
+# python2.7 setup.py ../data/prediction-images --full
+# python2.7 setup.py ../data/prediction-images --verify
+# python2.7 setup.py ../tmp/images --base-url http://localhost:8000/mgram_pict.php
 
 """ Maximum number of days in the past we can reach for """
 distant_past = 156
 
-""" All the main cities we use as data sources """
+""" Number of consecutive missing meteorograms after which we stop probing older dates of a location """
+max_misses = 8
+
+""" Grid point of the meteo.pl model, indexable as [row, col] like the entries of locations """
+Location = collections.namedtuple('Location', ['row', 'col', 'name'])
+
+""" All the main cities we use as data sources, used when no location registry is passed """
 locations = [
     [379, 285], # Bialystok
     [381, 199], # Bydgoszcz
@@ -41,8 +58,24 @@ locations = [
     [412, 155], # Zielona Gora
 ]
 
-def get_url(location, date, time):
-    return 'http://www.meteo.pl/um/metco/mgram_pict.php?ntype=0u&fdate={date!s}{time:02d}&row={row!s}&col={col!s}&lang=pl'.format(
+""" Size of a chunk in which the downloaded meteorograms are written to disk """
+chunk_size = 64 * 1024
+
+""" Downloaded files smaller than that are considered truncated """
+min_meteorogram_size = 1024
+
+""" Meteorogram endpoint of meteo.pl, any other server with the same query parameters can be used instead """
+meteorogram_url = 'http://www.meteo.pl/um/metco/mgram_pict.php'
+
+""" Maximum number of redirects followed by a single request """
+max_redirects = 5
+
+png_signature = '\x89PNG\r\n\x1a\n'
+png_trailer = '\x00\x00\x00\x00IEND\xaeB`\x82'
+
+def get_url(location, date, time, base_url=meteorogram_url):
+    return '{base_url!s}?ntype=0u&fdate={date!s}{time:02d}&row={row!s}&col={col!s}&lang=pl'.format(
+            base_url=base_url,
             date=date.strftime("%Y%m%d"),
             time=time,
             row=location[0],
@@ -54,31 +87,573 @@ def get_url(location, date, time):
             col=location[1]            
         )
 
-def download_meteorogram(url, destination_path):
-    print('Downloading {url} => {file}'.format(url=url, file=destination_path))
+class HostConnectionPool(object):
+    """
+    Pool of keep-alive HTTP and HTTPS connections grouped by scheme and host.
+    Connections are handed out one per request and returned to the pool once the response has been read.
+    """
+
+    def __init__(self, max_connections_per_host, timeout=30):
+        """
+        Args:
+            max_connections_per_host (int): maximum number of idle connections kept open for a single host.
+            timeout (int): socket timeout of a single connection (in seconds).
+        """
+        assert type(max_connections_per_host) is int, 'max_connections_per_host: passed object of incorrect type'
+
+        self._max_connections_per_host = max_connections_per_host
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, host):
+        """ Method returns an idle connection to the host or opens a new one """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self._timeout)
+        return httplib.HTTPConnection(host, timeout=self._timeout)
+
+    def release(self, scheme, host, connection):
+        """ Method returns a connection to the pool, connections above the limit are closed """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self._max_connections_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """ Method closes all the idle connections """
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+class HostRateLimiter(object):
+    """ Class which enforces a minimal interval between two consecutive requests sent to the same host. """
+
+    def __init__(self, min_interval):
+        """
+        Args:
+            min_interval (float): minimal interval between requests to a single host (in seconds).
+        """
+        assert type(min_interval) is float, 'min_interval: passed object of incorrect type'
+
+        self._min_interval = min_interval
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """ Method blocks until the next request to the host is allowed """
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self._min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class MeteorogramDownloader(object):
+    """
+    Class responsible for downloading meteorograms with a bounded pool of worker threads.
+    Requests reuse keep-alive connections, are rate limited per host and retried with an exponential backoff.
+    """
+
+    def __init__(self, workers=4, rate_limit=0.0, retries=3, backoff=1.0, manifest=None, base_url=meteorogram_url):
+        """
+        Args:
+            workers (int): number of concurrent downloads.
+            rate_limit (float): minimal interval between requests to a single host (in seconds).
+            retries (int): number of retries of a failed request.
+            backoff (float): delay before the first retry, doubled with every subsequent retry (in seconds).
+            manifest (DirectoryManifest): manifest of the destination directory updated with every download.
+            base_url (str): meteorogram endpoint, e.g. a local server which stands in for meteo.pl.
+        """
+        assert type(workers) is int and workers > 0, 'workers: passed object of incorrect type'
+        assert type(rate_limit) is float, 'rate_limit: passed object of incorrect type'
+        assert type(retries) is int, 'retries: passed object of incorrect type'
+        assert type(backoff) is float, 'backoff: passed object of incorrect type'
+
+        self._workers = workers
+        self._retries = retries
+        self._backoff = backoff
+        self._manifest = manifest
+        self.base_url = base_url
+        self._connections = HostConnectionPool(workers)
+        self._rate_limiter = HostRateLimiter(rate_limit)
+
+    def download(self, url, destination_path):
+        """
+        Method downloads a single meteorogram, errors are reported and swallowed.
+
+        Returns:
+            int: HTTP status of the response (200 if the meteorogram was stored), None on connection errors.
+        """
+        print('Downloading {url} => {file}'.format(url=url, file=destination_path))
+        try:
+            self._fetch(url, destination_path)
+            return 200
+        except urllib2.HTTPError, error:
+            print "HTTP Error:", error.code, url
+            return error.code
+        except urllib2.URLError, error:
+            print "URL Error:", error.reason, url
+        return None
+
+    def download_all(self, jobs):
+        """
+        Method downloads meteorograms concurrently.
+
+        Args:
+            jobs (iterable): pairs of (url, destination_path).
+
+        Returns:
+            int: Number of jobs which failed with an unexpected error.
+        """
+        return self.map(lambda job: self.download(*job), jobs)
+
+    def verify(self, directory):
+        """
+        Method finds truncated or corrupt meteorograms in the directory and downloads them again.
+        A corrupt file is replaced only by a valid download, one which failed leaves it in place for the next verification.
+        Files which names don't match the meteorogram pattern are left untouched.
+
+        Returns:
+            tuple: names of the files which were found corrupt and names of those which were downloaded again.
+        """
+        for filename in os.listdir(directory):
+            if filename.startswith('.') and filename.endswith('.part'):
+                os.remove(os.path.join(directory, filename))
+
+        filenames = [filename for filename in os.listdir(directory) if filename.endswith('.png')]
+        corrupt = []
+        repaired = []
+        lock = threading.Lock()
+
+        def verify_file(filename):
+            path = os.path.join(directory, filename)
+            if is_valid_png(path):
+                return
+            try:
+                url, _ = get_url(*parse_filename(filename), base_url=self.base_url)
+            except ValueError:
+                print('Skipped {file}, it is not a meteorogram'.format(file=filename))
+                return
+
+            with lock:
+                corrupt.append(filename)
+            print('Corrupt meteorogram {file}'.format(file=filename))
+            if self.download(url, path) == 200:
+                with lock:
+                    repaired.append(filename)
+
+        self.map(verify_file, filenames)
+        return corrupt, repaired
+
+    def close(self):
+        self._connections.close()
+
+    def _fetch(self, url, destination_path):
+        """ Method performs a request, retrying server and connection errors """
+        attempt = 0
+        while True:
+            try:
+                return self._fetch_once(url, destination_path)
+            except urllib2.HTTPError, error:
+                if (error.code < 500 and error.code != 429) or attempt >= self._retries:
+                    raise
+            except urllib2.URLError:
+                if attempt >= self._retries:
+                    raise
+            time.sleep(self._backoff * 2 ** attempt)
+            attempt += 1
+
+    def _fetch_once(self, url, destination_path):
+        """ Method sends a single request through pooled connections, following at most max_redirects redirects """
+        for _ in range(max_redirects):
+            location = self._request(url, destination_path)
+            if location is None:
+                return
+            url = urlparse.urljoin(url, location)
+
+        raise urllib2.HTTPError(url, 310, 'Too many redirects', None, None)
+
+    def _request(self, url, destination_path):
+        """
+        Method sends a single request through a pooled connection.
+
+        Returns:
+            str: Location of the redirect, None if the meteorogram was stored.
+        """
+        parsed_url = urlparse.urlsplit(url)
+        scheme = parsed_url.scheme or 'http'
+        host = parsed_url.netloc
+        path = urlparse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+
+        self._rate_limiter.wait(host)
+        connection = self._connections.acquire(scheme, host)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            location = response.getheader('location') if response.status in (301, 302, 303, 307, 308) else None
+            if response.status != 200:
+                response.read()
+            else:
+                self._write_atomically(response, destination_path)
+        except (httplib.HTTPException, socket.error), error:
+            connection.close()
+            raise urllib2.URLError(error)
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._connections.release(scheme, host, connection)
+
+        if location:
+            return location
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+    def _write_atomically(self, response, destination_path):
+        """
+        Method streams the response body into a temporary file next to the destination_path.
+        The file is renamed to destination_path only when it was fully written and contains a valid PNG,
+        so an interrupted download never leaves a truncated meteorogram behind.
+        """
+        destination_dir = os.path.dirname(os.path.abspath(destination_path))
+        file_descriptor, temp_path = tempfile.mkstemp(dir=destination_dir, prefix='.', suffix='.part')
+        checksum = hashlib.md5()
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file_writer:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    checksum.update(chunk)
+                    file_writer.write(chunk)
+                file_writer.flush()
+                os.fsync(file_writer.fileno())
+
+            if not is_valid_png(temp_path):
+                raise urllib2.URLError('Invalid PNG content')
+            os.rename(temp_path, destination_path)
+
+            if self._manifest is not None:
+                self._manifest.add_file(os.path.basename(destination_path), checksum.hexdigest())
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def map(self, fn, items):
+        """
+        Method calls fn for every item using a bounded number of worker threads.
+        An exception raised by fn is reported and the worker continues with the next item.
+
+        Returns:
+            int: Number of items for which fn failed.
+        """
+        queue = Queue.Queue(maxsize=self._workers * 2)
+        done = object()
+        failed = [0]
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                item = queue.get()
+                if item is done:
+                    return
+                try:
+                    fn(item)
+                except Exception, error:
+                    print('Failed {item}: {error!r}'.format(item=item, error=error))
+                    with lock:
+                        failed[0] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(self._workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for item in items:
+            queue.put(item)
+        for _ in threads:
+            queue.put(done)
+
+        # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+
+        return failed[0]
+
+def load_locations(registry_path):
+    """
+    Method loads a location registry from a CSV file (with a header row) or a JSON file (list of objects).
+    Every location is described by name, row and col of the model's grid point, names are utf-8 encoded.
+
+    Returns:
+        list: Location objects in the registry's order.
+    """
+    with open(registry_path) as infile:
+        if registry_path.endswith('.json'):
+            entries = json.load(infile)
+        else:
+            entries = list(csv.DictReader(infile))
+
+    registry = []
+    for entry in entries:
+        name = entry.get('name') or ''
+        if isinstance(name, unicode):
+            name = name.encode('utf-8') # json gives unicode names, CSV gives utf-8 encoded ones, e.g. Bia\xc5\x82ystok
+        registry.append(Location(int(entry['row']), int(entry['col']), name))
+    return registry
+
+def shard_locations(locations, shard_index, shard_count):
+    """
+    Method returns the part of locations assigned to a single downloader process.
+    Assignment depends only on the grid point, so every host computes the same partition
+    regardless of the order of the registry.
+    """
+    assert 0 <= shard_index < shard_count, 'shard_index: out of range'
+    return [
+        location for location in locations
+        if (zlib.crc32('{row!s}-{col!s}'.format(row=location[0], col=location[1])) & 0xffffffff) % shard_count == shard_index
+    ]
+
+def parse_filename(filename):
+    """
+    Inverse of get_url, recovers the meteorogram's location, date and time from its filename.
+
+    Returns:
+        tuple: ([row, col], date, time)
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    fdate, row, col = stem.split('-')
+    date = datetime.datetime.strptime(fdate[:8], "%Y%m%d").date()
+    return [int(row), int(col)], date, int(fdate[8:])
+
+def is_valid_png(path):
+    """ Method checks whether the file is a complete PNG image (signature, trailer and a sane size) """
     try:
-        response = urllib2.urlopen(url)
-        with open(destination_path, 'wb') as file_writer:
-            file_writer.write(response.read())
-    except urllib2.HTTPError, error:
-        print "HTTP Error:", error.code, url
-    except urllib2.URLError, error:
-        print "URL Error:", error.reason, url
+        size = os.path.getsize(path)
+        if size < max(min_meteorogram_size, len(png_signature) + len(png_trailer)):
+            return False
+        with open(path, 'rb') as file_reader:
+            if file_reader.read(len(png_signature)) != png_signature:
+                return False
+            file_reader.seek(-len(png_trailer), os.SEEK_END)
+            return file_reader.read(len(png_trailer)) == png_trailer
+    except (IOError, OSError):
+        return False
 
-# Execution section
-if __name__ == "__main__":
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
+class DownloadScheduler(object):
+    """
+    Class which decides which meteorograms should be downloaded for every location.
+    A frontier is kept for each location in a state file, all the slots older than the frontier are settled
+    (fetched, or not found although a newer model run was published), so a run enumerates only the slots
+    from today back to the frontier instead of the whole distant_past window. Slots which failed
+    or weren't reached by an interrupted run stay above the frontier and are tried again by the next run.
+    """
+
+    def __init__(self, state_path, distant_past, max_misses):
+        """
+        Args:
+            state_path (str): path to the json file where the frontiers of the locations are stored.
+            distant_past (int): maximum number of days in the past we can reach for.
+            max_misses (int): number of consecutive 404 responses after which a location is no longer probed.
+        """
+        assert type(state_path) is str, 'state_path: passed object of incorrect type'
+        assert type(distant_past) is int, 'distant_past: passed object of incorrect type'
+        assert type(max_misses) is int, 'max_misses: passed object of incorrect type'
+
+        self._state_path = state_path
+        self._distant_past = distant_past
+        self._max_misses = max_misses
+        self._frontiers = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(state_path):
+            with open(state_path) as infile:
+                self._frontiers = json.load(infile)
+
+    @staticmethod
+    def path_for(directory):
+        """
+        Returns:
+            str: Path of the scheduler's state file of the directory, e.g. ../data/training-images-state.json
+        """
+        return os.path.normpath(directory) + '-state.json'
+
+    def slots(self, location, today):
+        """
+        Generator of (date, time) slots of a location which aren't settled yet, the newest first.
+        """
+        frontier = self._frontiers.get(self._location_key(location))
+        for day in range(0, self._distant_past):
+            date = today-datetime.timedelta(days=day)
+            for time in range(18, -1, -6):
+                if frontier is not None and self._fdate(date, time) < frontier:
+                    return
+                yield date, time
+
+    def download_location(self, downloader, location, destination_dir, existing_files, today):
+        """
+        Method downloads missing meteorograms of a single location, going back in time
+        until max_misses consecutive meteorograms are reported as not found by the upstream.
+        The frontier of the location is moved only when the run reached the previous frontier or stopped probing.
+        """
+        misses = 0
+        newest = None
+        oldest_unsettled = None
+        published = False
+
+        for date, time in self.slots(location, today):
+            url, filename = get_url(location, date, time, downloader.base_url)
+            if filename in existing_files:
+                status = 200
+            else:
+                status = downloader.download(url, os.path.join(destination_dir, filename))
+
+            fdate = self._fdate(date, time)
+            newest = newest or fdate
+
+            # A missing meteorogram is settled only if a newer model run was published, otherwise it may still appear
+            if status == 200:
+                published = True
+                misses = 0
+            elif status == 404:
+                misses += 1
+                if not published:
+                    oldest_unsettled = fdate
+                if misses >= self._max_misses:
+                    print('Stopped probing location {row}-{col} at {date}'.format(row=location[0], col=location[1], date=date))
+                    break
+            else:
+                oldest_unsettled = fdate
+
+        if newest is not None:
+            self._advance(location, oldest_unsettled or newest)
 
+    def _advance(self, location, frontier):
+        """ Method marks all the slots of the location older than frontier as settled """
+        with self._lock:
+            self._frontiers[self._location_key(location)] = frontier
+
+    def download_all(self, downloader, locations, destination_dir, existing_files):
+        """
+        Method downloads missing meteorograms of all the locations, locations are processed concurrently.
+
+        Returns:
+            int: Number of locations which failed with an unexpected error.
+        """
+        today = datetime.date.today()
+        return downloader.map(
+            lambda location: self.download_location(downloader, location, destination_dir, existing_files, today),
+            locations
+        )
+
+    def save(self):
+        """ Method atomically saves the frontiers of the locations """
+        with self._lock:
+            frontiers = dict(self._frontiers)
+
+        write_atomically(self._state_path, json.dumps(frontiers, indent=4, separators=(',', ':'), sort_keys=True))
+
+    def _location_key(self, location):
+        return '{row!s}-{col!s}'.format(row=location[0], col=location[1])
+
+    def _fdate(self, date, time):
+        return '{date!s}{time:02d}'.format(date=date.strftime("%Y%m%d"), time=time)
+
+def download_meteorogram(url, destination_path):
+    downloader = MeteorogramDownloader(workers=1)
+    downloader.download(url, destination_path)
+    downloader.close()
+
+def get_download_jobs(locations, destination_dir, existing_files, base_url=meteorogram_url):
+    """
+    Generator of (url, destination_path) pairs for all meteorograms which were not downloaded yet
+
+    Args:
+        locations (list): locations for which meteorograms will be downloaded.
+        destination_dir (str): directory where the meteorograms will be stored.
+        existing_files (set): names of the files which are already downloaded.
+        base_url (str): meteorogram endpoint.
+    """
     for location in locations:
         for day in range(0, distant_past):
             date = datetime.date.today()-datetime.timedelta(days=day)
             for time in range(0, 24, 6):
-                url , filename = get_url(location, date, time)
-                download_path = os.path.join(destination_dir, filename)
-                filter_path = os.path.join(filter_dir, filename)
+                url , filename = get_url(location, date, time, base_url)
 
-                if not os.path.exists(filter_path) and not os.path.exists(download_path):
-                    download_meteorogram(url,download_path)
+                if not filename in existing_files:
+                    yield url, os.path.join(destination_dir, filename)
                 else:
                     print('Skipped download of {file}'.format(file=filename))
+
+# Execution section
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Downloads meteorograms from meteo.pl')
+    parser.add_argument('destination_dir', help='directory where the downloaded meteorograms will be stored')
+    parser.add_argument('--locations', help='CSV or JSON location registry with name, row and col of every location (defaults to the main cities)')
+    parser.add_argument('--shard', default='0/1', help='part of the locations downloaded by this process, e.g. 2/4')
+    parser.add_argument('--filter-dir', help='files already present in this directory are skipped (defaults to destination_dir)')
+    parser.add_argument('--workers', type=int, default=4, help='number of concurrent downloads')
+    parser.add_argument('--rate-limit', type=float, default=0.1, help='minimal interval between requests to a single host (in seconds)')
+    parser.add_argument('--retries', type=int, default=3, help='number of retries of a failed request')
+    parser.add_argument('--full', action='store_true', help='sweep the whole distant_past window instead of meteorograms published since the last run')
+    parser.add_argument('--max-misses', type=int, default=max_misses, help='consecutive missing meteorograms after which older dates of a location are not probed')
+    parser.add_argument('--verify', action='store_true', help='re-download truncated or corrupt meteorograms instead of fetching new ones')
+    parser.add_argument('--base-url', default=meteorogram_url, help='meteorogram endpoint, e.g. a local server which stands in for meteo.pl')
+    args = parser.parse_args()
+
+    """ Directory when we will store all the downloaded meteorograms """
+    destination_dir = args.destination_dir
+
+    """ We skip files which are already present in this directory """
+    filter_dir = args.filter_dir or destination_dir
+
+    if not os.path.exists(destination_dir):
+        os.makedirs(destination_dir)
+
+    shard_index, shard_count = [int(value) for value in args.shard.split('/')]
+    if args.locations:
+        locations = load_locations(args.locations)
+    locations = shard_locations(locations, shard_index, shard_count)
+
+    # A single directory listing replaces per-file existence checks
+    manifest = DirectoryManifest(destination_dir)
+    manifest.sync()
+    existing_files = manifest.filenames
+
+    if os.path.normpath(filter_dir) != os.path.normpath(destination_dir):
+        filter_manifest = DirectoryManifest(filter_dir)
+        filter_manifest.sync()
+        existing_files |= filter_manifest.filenames
+
+    downloader = MeteorogramDownloader(workers=args.workers, rate_limit=args.rate_limit, retries=args.retries, manifest=manifest, base_url=args.base_url)
+    try:
+        if args.verify:
+            corrupt, repaired = downloader.verify(destination_dir)
+            print('Verified {dir}: {count} corrupt meteorograms, {repaired} downloaded again, {left} left for the next verification'.format(
+                dir=destination_dir, count=len(corrupt), repaired=len(repaired), left=len(corrupt) - len(repaired)
+            ))
+        elif args.full:
+            failed = downloader.download_all(get_download_jobs(locations, destination_dir, existing_files, args.base_url))
+            print('{count} downloads failed with an unexpected error'.format(count=failed))
+        else:
+            scheduler = DownloadScheduler(DownloadScheduler.path_for(destination_dir), distant_past, args.max_misses)
+            try:
+                failed = scheduler.download_all(downloader, locations, destination_dir, existing_files)
+                print('{count} locations failed with an unexpected error'.format(count=failed))
+            finally:
+                scheduler.save()
+    finally:
+        downloader.close()
+        manifest.save()